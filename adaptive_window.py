@@ -0,0 +1,126 @@
+'''
+Adaptive fetchmany window sizing (--adaptive_window)
+
+Each kind of query ('claims', 'claims history (per PID)', 'control index', ...) gets a WindowSizer, shared by
+every cursor of that kind in the run. It starts at config['WINDOW_SIZE'] and, after each full window, picks the
+next size from what it measured: enough rows for TARGET_SECS of fetching at the observed rows/sec, capped so a
+window stays under MAX_WINDOW_MB (estimated bytes per row), and halved while the process RSS is above MAX_RSS_MB.
+A size changes by at most 2x per window and stays within MIN_ROWS..MAX_ROWS. The bounds come from
+config['ADAPTIVE_WINDOW'] (all optional). Sizes and the reasons they changed go into the run report
+'''
+import pickle
+from time import perf_counter
+from run_metrics import current_rss_mb
+
+DEFAULT_BOUNDS = {'MIN_ROWS': 100, 'MAX_ROWS': 200000, 'TARGET_SECS': 0.5, 'MAX_WINDOW_MB': 64, 'MAX_RSS_MB': None}
+MAX_CHANGES_LOGGED = 50
+
+_SIZERS = {}
+
+
+class WindowSizer():
+    """the window size of one kind of query, adjusted from the windows fetched so far"""
+    def __init__(self, name, initial, bounds):
+        self.name = name
+        self.initial = initial
+        self.size = initial
+        self.bounds = bounds
+        self.windows = 0
+        self.rows = 0
+        self.fetch_secs = 0.0
+        self.bytes_per_row = None
+        self.smallest = initial
+        self.largest = initial
+        self.changes = []
+
+    def observe(self, requested, rows, secs, bytes_per_row):
+        self.windows += 1
+        self.rows += rows
+        self.fetch_secs += secs
+        if bytes_per_row:
+            self.bytes_per_row = bytes_per_row
+        # a short window is the end of the result set and says nothing about throughput
+        if rows < requested or secs <= 0:
+            return
+        reason = 'throughput'
+        size = rows / secs * self.bounds['TARGET_SECS']
+        if self.bytes_per_row:
+            by_memory = self.bounds['MAX_WINDOW_MB'] * 2**20 / self.bytes_per_row
+            if by_memory < size:
+                size, reason = by_memory, 'window memory'
+        max_rss = self.bounds['MAX_RSS_MB']
+        if max_rss:
+            rss = current_rss_mb()
+            if rss is not None and rss > max_rss:
+                size, reason = min(size, self.size / 2), 'rss {} MB'.format(rss)
+        size = int(min(max(size, self.size / 2, self.bounds['MIN_ROWS']), self.size * 2, self.bounds['MAX_ROWS']))
+        if abs(size - self.size) > self.size / 10:
+            if len(self.changes) < MAX_CHANGES_LOGGED:
+                self.changes.append({'window': self.windows, 'size': size, 'reason': reason,
+                                     'rows_per_sec': round(rows / secs), 'bytes_per_row': self.bytes_per_row})
+            self.size = size
+            self.smallest = min(self.smallest, size)
+            self.largest = max(self.largest, size)
+
+    def to_dict(self):
+        return {'initial': self.initial,
+                'final': self.size,
+                'min': self.smallest,
+                'max': self.largest,
+                'windows': self.windows,
+                'rows': self.rows,
+                'fetch_secs': round(self.fetch_secs, 3),
+                'rows_per_sec': round(self.rows / self.fetch_secs) if self.fetch_secs else None,
+                'bytes_per_row': self.bytes_per_row,
+                'changes': self.changes}
+
+
+class AdaptiveCursor():
+    '''
+    Wraps a result set and fetches windows of the sizer's current size (the `size` asked for is ignored),
+    reporting each window's rows, fetch time and estimated bytes per row back to the sizer
+    '''
+    def __init__(self, results, sizer):
+        self.results = results
+        self.sizer = sizer
+
+    def keys(self):
+        return self.results.keys()
+
+    def fetchmany(self, size=None):
+        requested = self.sizer.size
+        start = perf_counter()
+        batch = self.results.fetchmany(requested)
+        secs = perf_counter() - start
+        bytes_per_row = len(pickle.dumps(tuple(batch[0]), protocol=pickle.HIGHEST_PROTOCOL)) if batch else None
+        self.sizer.observe(requested, len(batch), secs, bytes_per_row)
+        return batch
+
+    def __iter__(self):
+        batch = self.fetchmany()
+        while batch:
+            for row in batch:
+                yield row
+            batch = self.fetchmany()
+
+
+def get_window_sizer(name, config):
+    sizer = _SIZERS.get(name)
+    if sizer is None:
+        bounds = dict(DEFAULT_BOUNDS)
+        bounds.update(config.get('ADAPTIVE_WINDOW') or {})
+        sizer = _SIZERS[name] = WindowSizer(name, config['WINDOW_SIZE'], bounds)
+    return sizer
+
+
+def adaptive(results, name, config):
+    return AdaptiveCursor(results, get_window_sizer(name, config))
+
+
+def window_report():
+    """{query kind: sizer summary} of this process"""
+    return {name: sizer.to_dict() for name, sizer in _SIZERS.items()}
+
+
+def reset_windows():
+    _SIZERS.clear()
@@ -0,0 +1,88 @@
+'''
+Length-bucketed batch index for RETAIN training
+
+Instances (rows of a data file) are grouped into buckets of similar visit counts, shuffled within their bucket
+with a seed, and cut into batches of at most `max_tokens` padded visits (batch size x longest sequence in the batch).
+The batch order is shuffled with the same generator, so training can read padding-efficient batches in order
+without loading and sorting the data file. The index is a pickled dict saved next to the data/target files:
+  batches          list of int64 arrays   row positions (iloc) in the data file of each batch
+  batch_buckets    int64 array            bucket of each batch
+  buckets          DataFrame              per bucket: visit count range, instances, batches, visits, padded visits, fill
+  bucket_bounds    list                   upper visit count of each bucket
+  max_tokens, seed
+An instance longer than `max_tokens` gets a batch of its own
+'''
+import pickle
+import numpy as np
+import pandas as pd
+
+BUCKET_GROWTH = 1.25
+
+
+def bucket_bounds(max_len, growth=BUCKET_GROWTH):
+    """upper visit counts of geometrically growing buckets (1, 2, ..., 8, 10, 12, 15, 18, ...) up to `max_len`"""
+    bounds = [1]
+    while bounds[-1] < max_len:
+        bounds.append(max(bounds[-1] + 1, int(bounds[-1] * growth)))
+    return bounds
+
+
+def build_batch_index(lengths, max_tokens, seed=None):
+    '''
+    the batch index (see the module docstring) of instances with visit counts `lengths`, in data file order
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    bounds = bucket_bounds(int(lengths.max()) if len(lengths) else 1)
+    buckets = np.searchsorted(bounds, lengths)
+    batches = []
+    batch_buckets = []
+    stats = []
+    for bucket, upper in enumerate(bounds):
+        members = np.flatnonzero(buckets == bucket)
+        if not len(members):
+            continue
+        members = members[rng.permutation(len(members))]
+        num_batches = len(batches)
+        padded = 0
+        start = 0
+        longest = 0
+        for pos, length in enumerate(lengths[members]):
+            length = max(int(length), 1)
+            if pos > start and (pos - start + 1) * max(longest, length) > max_tokens:
+                batches.append(members[start:pos])
+                padded += (pos - start) * longest
+                start = pos
+                longest = 0
+            longest = max(longest, length)
+        batches.append(members[start:])
+        padded += (len(members) - start) * longest
+        batch_buckets.extend([bucket] * (len(batches) - num_batches))
+        visits = int(lengths[members].sum())
+        stats.append({'bucket': bucket, 'min_visits': bounds[bucket - 1] + 1 if bucket else 0, 'max_visits': upper,
+                      'instances': len(members), 'batches': len(batches) - num_batches,
+                      'visits': visits, 'padded_visits': padded, 'fill': round(visits / padded, 4) if padded else 1.0})
+    order = rng.permutation(len(batches))
+    return {'batches': [batches[pos] for pos in order],
+            'batch_buckets': np.array(batch_buckets, dtype=np.int64)[order],
+            'buckets': pd.DataFrame(stats, columns=['bucket', 'min_visits', 'max_visits', 'instances', 'batches',
+                                                    'visits', 'padded_visits', 'fill']),
+            'bucket_bounds': bounds,
+            'max_tokens': max_tokens,
+            'seed': seed}
+
+
+def write_batch_index(lengths, index_file, max_tokens, seed=None):
+    index = build_batch_index(lengths, max_tokens, seed)
+    with open(index_file, 'wb') as fout:
+        pickle.dump(index, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    buckets = index['buckets']
+    print("Batch index created: {} ({} batches in {} buckets, {:.1%} of padded visits used)".format(
+        index_file, len(index['batches']), len(buckets),
+        buckets['visits'].sum() / buckets['padded_visits'].sum() if buckets['padded_visits'].sum() else 1.0))
+    return index
+
+
+def load_batch_index(index_file):
+    with open(index_file, 'rb') as fin:
+        return pickle.load(fin)
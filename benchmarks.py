@@ -0,0 +1,258 @@
+""" Benchmarks for the HICOR extraction pipeline on synthetic data (no SQL server required) """
+import argparse
+from contextlib import redirect_stderr, redirect_stdout
+from copy import deepcopy
+import io
+import json
+import os
+import random
+import tempfile
+from time import perf_counter
+import tracemalloc
+from pidcounter import PID_Counter
+from process_hicor import DataDictionary, build_visit_dict, load_into_df
+from process_hicor import parse_arguments as parse_pipeline_arguments
+from synthetic_hicor import build_database, read_column_order
+from sql_engine import initialize_sqlite
+from visit_encoder import VisitEncoder
+
+# pipeline modes timed by the end-to-end suite: (label, process_hicor.py arguments)
+E2E_MODES = [('split_on_events', []),
+             ('split_on_events --use_partials', ['--use_partials', '--bulk_partials']),
+             ('split_on_matched_control', ['--match_num', '2', '--bulk_history']),
+             ('split_on_matched_control --day_instance', ['--day_instance', '--bulk_history'])]
+
+
+def load_config():
+    """use config.json when present, falling back to the checked-in defaults"""
+    path = './config.json' if os.path.exists('./config.json') else './config_default.json'
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def make_synthetic_rows(datadict, columns, num_rows, seed=0, patients=None):
+    '''
+    generate claim-day tuples in `columns` order, ordered by PID then DAY
+    binary code columns are sparse (~2% set), char code columns draw from the known code values
+    '''
+    rng = random.Random(seed)
+    char_values = {}
+    for key in datadict.code_mappings:
+        for col, codekey in datadict.code_cols.items():
+            if codekey[1] != 'Binary' and key.startswith(col + '_'):
+                char_values.setdefault(col, []).append(key[len(col) + 1:])
+    patients = patients or max(1, num_rows // 50)
+    rows_per_pid = max(1, num_rows // patients)
+    rows = []
+    for row_num in range(num_rows):
+        pid = "{}".format(170300000000 + row_num // rows_per_pid)
+        day = row_num % rows_per_pid + 1
+        values = []
+        for col in columns:
+            if col == 'PID':
+                values.append(pid)
+            elif col == 'DAY':
+                values.append(day)
+            elif col in ('ED', 'IP'):
+                values.append(1 if rng.random() < 0.02 else 0)
+            elif col == 'ANYCLAIM':
+                values.append(1)
+            elif col in datadict.code_cols:
+                if datadict.code_cols[col][1] == 'Binary':
+                    values.append(1 if rng.random() < 0.02 else 0)
+                else:
+                    options = char_values.get(col)
+                    values.append(rng.choice(options) if options and rng.random() < 0.9 else None)
+            elif col in datadict.numeric_cols:
+                values.append(None if rng.random() < 0.1 else rng.randint(0, 9999))
+            else:
+                values.append(None)
+        rows.append(tuple(values))
+    return rows
+
+
+def bench_encoder(datadict, columns, rows, config, window_size=10000):
+    '''
+    time the dict-walking build_visit_dict against the compiled VisitEncoder (row by row and
+    batched per fetch window) on the same rows, and check that all paths produce identical visits
+    '''
+    error_cols = set()
+    start = perf_counter()
+    old_visits = [build_visit_dict(dict(zip(columns, row)), datadict, error_cols, config) for row in rows]
+    old_secs = perf_counter() - start
+
+    start = perf_counter()
+    encoder = VisitEncoder(datadict, columns, config)
+    compile_secs = perf_counter() - start
+    new_error_cols = set()
+    start = perf_counter()
+    new_visits = [encoder.encode(row, new_error_cols) for row in rows]
+    new_secs = perf_counter() - start
+
+    batch_error_cols = set()
+    start = perf_counter()
+    batch_visits = []
+    for offset in range(0, len(rows), window_size):
+        batch_visits.extend(encoder.encode_batch(rows[offset:offset + window_size], batch_error_cols))
+    batch_secs = perf_counter() - start
+
+    if old_visits != new_visits or error_cols != new_error_cols:
+        raise AssertionError("VisitEncoder output differs from build_visit_dict")
+    if old_visits != batch_visits or error_cols != batch_error_cols:
+        raise AssertionError("VisitEncoder.encode_batch output differs from build_visit_dict")
+    print("build_visit_dict:          {:>12,.0f} rows/sec".format(len(rows) / old_secs))
+    print("VisitEncoder.encode:       {:>12,.0f} rows/sec (compiled in {:.3f}s)".format(len(rows) / new_secs, compile_secs))
+    print("VisitEncoder.encode_batch: {:>12,.0f} rows/sec (window of {})".format(len(rows) / batch_secs, window_size))
+    print("speedup (row/batch):       {:>12.1f}x / {:.1f}x".format(old_secs / new_secs, old_secs / batch_secs))
+    return old_secs, new_secs, batch_secs
+
+
+class NullWriter():
+    """writer that drops rows, so benchmarks only measure the PID_Counter side"""
+    def writerows(self, rows):
+        pass
+
+
+class DeepcopyPIDCounter(PID_Counter):
+    '''
+    the previous PID_Counter behaviour, kept as a benchmark baseline:
+    every new event deep-copies all rows seen so far for the patient
+    '''
+    def _dupe_events(self, day=None):
+        new_PID = "_".join([str(self.pid), str(self.pid_event_count)])
+        duped_rows = deepcopy(self.pid_rows)
+        if day and self.partial_events.get(day):
+            duped_rows.append(self.partial_events[day])
+        self.duped_rows.append((new_PID, duped_rows))
+
+    def _view_rows(self, view):
+        return view
+
+
+def make_event_patient(num_events, days_between=5, num_codes=20, num_numerics=7, seed=0):
+    '''
+    visit rows for one synthetic patient with `num_events` separate ED events
+    (events are `days_between` days apart, so each one counts as a new event)
+    '''
+    rng = random.Random(seed)
+    rows = []
+    for day in range(1, num_events * days_between + 1):
+        rows.append({'PID': '170300000001',
+                     'numerics': [rng.randint(0, 9999) for _ in range(num_numerics)],
+                     'DAY': day,
+                     'ED': 1 if day % days_between == 0 else 0,
+                     'IP': 0,
+                     'codes': rng.sample(range(1, 2770), num_codes)})
+    return rows
+
+
+def bench_pid_counter(event_counts=(1, 10, 100, 500)):
+    '''
+    time and peak traced memory of running one patient through PID_Counter (process + convert + write)
+    for the prefix-view representation against the deepcopy baseline
+    '''
+    def _run(counter_cls, rows):
+        pid_counter = counter_cls(preferred_types=['ED'])
+        pid_counter.reset_for_new_pid(rows[0]['PID'])
+        for row in rows:
+            pid_counter.process_row(row)
+        pid_counter.convert_and_write(NullWriter())
+        return pid_counter
+
+    print("{:>7} {:>7} | {:>12} {:>12} | {:>12} {:>12}".format(
+        'events', 'rows', 'deepcopy s', 'views s', 'deepcopy MB', 'views MB'))
+    for num_events in event_counts:
+        rows = make_event_patient(num_events)
+        results = []
+        for counter_cls in (DeepcopyPIDCounter, PID_Counter):
+            start = perf_counter()
+            _run(counter_cls, rows)
+            secs = perf_counter() - start
+            tracemalloc.start()
+            _run(counter_cls, rows)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((secs, peak / 2**20))
+        print("{:>7} {:>7} | {:>12.4f} {:>12.4f} | {:>12.1f} {:>12.1f}".format(
+            num_events, len(rows), results[0][0], results[1][0], results[0][1], results[1][1]))
+
+
+def bench_pipeline(engine, config, datadict, argv, repeat=1):
+    '''
+    run load_into_df end to end with the given process_hicor.py arguments (pipeline output and progress bars silenced)
+    returns (best wall seconds, peak traced MB of one extra traced run, patient rows, claim-day rows read)
+    '''
+    pipeline_args = parse_pipeline_arguments(argparse.ArgumentParser(), argv)
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            df = load_into_df(engine, config, datadict, pipeline_args)
+        secs = perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    tracemalloc.start()
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        load_into_df(engine, config, datadict, pipeline_args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak / 2**20, len(df), int(df['codes'].str.len().sum()) if len(df) else 0
+
+
+def bench_end_to_end(config, datadict, sizes, seed=0, modes=E2E_MODES, repeat=1, db_dir=None):
+    '''
+    generate a synthetic SQLite database per patient count in `sizes` and time every pipeline mode on it
+    rows/sec counts claim-day visits written to the output (over both ED and IP outcomes)
+    '''
+    db_dir = db_dir or tempfile.mkdtemp(prefix='hicor_bench_')
+    results = []
+    print("{:>9} {:>10} | {:<42} {:>9} {:>9} {:>12} {:>10}".format(
+        'patients', 'claim-days', 'mode', 'secs', 'patients', 'visits/sec', 'peak MB'))
+    for num_patients in sizes:
+        path = os.path.join(db_dir, 'synthetic_{}_{}.db'.format(num_patients, seed))
+        counts = build_database(path, config, num_patients, seed, datadict)
+        with redirect_stdout(io.StringIO()):
+            engine = initialize_sqlite(path, seed=seed)
+        for label, argv in modes:
+            secs, peak_mb, patient_rows, visits = bench_pipeline(engine, config, datadict, argv, repeat)
+            results.append({'patients': num_patients, 'claims': counts['claims'], 'mode': label, 'secs': secs,
+                            'patient_rows': patient_rows, 'visits': visits, 'peak_mb': peak_mb})
+            print("{:>9} {:>10} | {:<42} {:>9.2f} {:>9} {:>12,.0f} {:>10.1f}".format(
+                num_patients, counts['claims'], label, secs, patient_rows, visits / secs if secs else 0, peak_mb))
+        engine.dispose()
+        os.remove(path)
+    return results
+
+
+def parse_arguments(parser):
+    """size and seed of the synthetic data used for benchmarking"""
+    parser.add_argument('--rows', type=int, default=20000,
+                        help="number of synthetic claim-day rows to generate")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed for synthetic data generation")
+    parser.add_argument('--events', type=int, nargs='+', default=[1, 10, 100, 500],
+                        help="events per synthetic patient for the PID_Counter benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help="synthetic patient counts for the end-to-end benchmark")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="end-to-end runs per mode and size (best time is reported)")
+    parser.add_argument('--no_e2e', action='store_true',
+                        help="skip the end-to-end benchmark against synthetic SQLite databases")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ARGS = parse_arguments(PARSER)
+
+    config = load_config()
+    ddict = DataDictionary()
+    columns = read_column_order()
+    print("Generating {} synthetic rows ({} columns)...".format(ARGS.rows, len(columns)))
+    rows = make_synthetic_rows(ddict, columns, ARGS.rows, ARGS.seed)
+    bench_encoder(ddict, columns, rows, config, config['WINDOW_SIZE'])
+    print("\nPID_Counter on single patients with N events:")
+    bench_pid_counter(ARGS.events)
+    if not ARGS.no_e2e:
+        print("\nEnd to end (load_into_df) on synthetic SQLite databases:")
+        bench_end_to_end(config, ddict, ARGS.sizes, ARGS.seed, repeat=ARGS.repeat)
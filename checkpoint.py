@@ -0,0 +1,132 @@
+'''
+Checkpoints for resumable extraction runs
+
+A checkpoint directory holds the finished patient rows of a run as numbered pickled part files, plus a
+JSON manifest recording, per pipeline stage, how far the run got (the last committed PID/DAY or event day,
+rows read, whether the stage is done). Stages may also keep records (e.g. collected instances) and a small
+pickled state next to it. Everything is written under a temporary name and moved into place, and the manifest
+is replaced last, so a run that dies mid-commit resumes from the previous commit.
+With --resume, each stage skips what the manifest says is committed, and the final output is rebuilt by
+replaying the part files in order into the real writer
+'''
+import json
+import os
+import pickle
+import shutil
+
+
+def _dump(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        pickle.dump(obj, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def _load(path):
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
+
+
+class Checkpoint():
+    '''
+    Writer with the csv.DictWriter `writerow(s)` interface that buffers rows until `commit`
+    `run_key` identifies the run's parameters: a manifest written for another key is never resumed from.
+    Commits happen when at least `commit_rows` rows/records are buffered (`maybe_commit`) or when a stage ends (`commit`)
+    '''
+    def __init__(self, checkpoint_dir, run_key, resume=False, commit_rows=50000):
+        self.checkpoint_dir = checkpoint_dir
+        self.run_key = run_key
+        self.commit_rows = commit_rows
+        self.buffer = []
+        self.pending = {}
+        self.manifest_file = os.path.join(checkpoint_dir, 'manifest.json')
+        manifest = self._read_manifest() if resume else None
+        if manifest is not None and manifest.get('run_key') == run_key:
+            print("Resuming from checkpoint {} ({} committed parts)".format(checkpoint_dir, len(manifest['parts'])))
+            self.manifest = manifest
+        else:
+            if resume:
+                print("No matching checkpoint at {}, starting from the beginning".format(checkpoint_dir))
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            os.makedirs(checkpoint_dir)
+            self.manifest = {'run_key': run_key, 'commits': 0, 'parts': [], 'records': {}, 'stages': {}}
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return None
+        with open(self.manifest_file) as fin:
+            return json.load(fin)
+
+    def writerow(self, row):
+        self.buffer.append(row)
+
+    def writerows(self, rows):
+        self.buffer.extend(rows)
+
+    def record(self, stage, record):
+        """keep `record` with the stage; returned by `records(stage)` on resume"""
+        self.pending.setdefault(stage, []).append(record)
+
+    def stage(self, stage):
+        """committed progress of `stage` ({} if it never committed)"""
+        return self.manifest['stages'].get(stage, {})
+
+    def state(self, stage):
+        """the pickled state committed with `stage`, if any"""
+        state_file = self.stage(stage).get('state_file')
+        return _load(os.path.join(self.checkpoint_dir, state_file)) if state_file else None
+
+    def records(self, stage):
+        records = []
+        for records_file in self.manifest['records'].get(stage, []):
+            records.extend(_load(os.path.join(self.checkpoint_dir, records_file)))
+        return records
+
+    def maybe_commit(self, stage, state=None, **progress):
+        if len(self.buffer) + sum(len(records) for records in self.pending.values()) >= self.commit_rows:
+            self.commit(stage, state, **progress)
+
+    def commit(self, stage, state=None, **progress):
+        '''
+        persist buffered rows and records, then record `progress` (JSON-able) and `state` (pickled) for `stage`
+        '''
+        if self.buffer:
+            part_file = 'part_{:05d}.pkl'.format(len(self.manifest['parts']))
+            _dump(self.buffer, os.path.join(self.checkpoint_dir, part_file))
+            self.manifest['parts'].append(part_file)
+            self.buffer = []
+        for record_stage, records in self.pending.items():
+            if records:
+                record_files = self.manifest['records'].setdefault(record_stage, [])
+                records_file = '{}_records_{:05d}.pkl'.format(record_stage, len(record_files))
+                _dump(records, os.path.join(self.checkpoint_dir, records_file))
+                record_files.append(records_file)
+        self.pending = {}
+        old_state_file = self.stage(stage).get('state_file')
+        self.manifest['commits'] = self.manifest.get('commits', 0) + 1
+        if state is not None:
+            # a new file per commit, so the state always matches the progress of the manifest that names it
+            progress['state_file'] = '{}_state_{:05d}.pkl'.format(stage, self.manifest['commits'])
+            _dump(state, os.path.join(self.checkpoint_dir, progress['state_file']))
+        self.manifest['stages'][stage] = progress
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(self.manifest, fout, indent=1, default=str)
+        os.replace(tmp_file, self.manifest_file)
+        if old_state_file and old_state_file != progress.get('state_file'):
+            os.remove(os.path.join(self.checkpoint_dir, old_state_file))
+
+    def replay(self, writer):
+        '''
+        write every committed row, in commit order, to `writer`; returns the number of rows
+        '''
+        rows = 0
+        for part_file in self.manifest['parts']:
+            part = _load(os.path.join(self.checkpoint_dir, part_file))
+            writer.writerows(part)
+            rows += len(part)
+        return rows
+
+    @staticmethod
+    def remove(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
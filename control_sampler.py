@@ -0,0 +1,92 @@
+""" In-memory eligibility index for matched-control negative sampling """
+import numpy as np
+from adaptive_window import adaptive
+
+
+class ControlSampler():
+    '''
+    Day -> eligible negative PID index built in one pass over the claims table, so matched controls
+    are drawn locally with a seeded RNG instead of one `select top N ... order by newid()` query per event day.
+    A PID is eligible on a day when it has an active (ANYCLAIM) non-event claim-day on that day and never
+    appears with an event in the partial event table (the same conditions as the per-day query).
+    Candidates are kept as sorted numpy arrays, so draws only depend on the seed and the data.
+    With `unique` set, a PID is drawn as a control at most once across all days (without replacement).
+    `columns` is the select list of the fetched control rows; with `adaptive`, the index scan's
+    fetch windows are sized by adaptive_window.py instead of WINDOW_SIZE
+    '''
+    def __init__(self, engine, config, dataset, event_condition, partition_clause='', days=None, seed=None, unique=False, columns='*', adaptive=False):
+        self.engine = engine
+        self.config = config
+        self.dataset = dataset
+        self.event_condition = event_condition
+        self.partition_clause = partition_clause
+        self.columns = columns
+        self.adaptive = adaptive
+        self.rng = np.random.default_rng(seed)
+        self.unique = unique
+        self.used = set()
+        self.excluded = self._excluded_pids()
+        self.index = self._build_index(set(days) if days is not None else None)
+
+    def _excluded_pids(self):
+        results = self.engine.execute('select distinct PID from {} where PID is not null and {}'
+                                      .format(self.config['PARTIAL_EVENT_TABLE_NAME'], self.event_condition))
+        return set(str(row[0]) for row in results)
+
+    def _build_index(self, days):
+        results = self.engine.execute("select PID, DAY from {} where PID is not null and ANYCLAIM!='0' and not {} and PROCESS1={}{}"
+                                      .format(self.config['TABLE_NAME'], self.event_condition, self.dataset, self.partition_clause))
+        if self.adaptive:
+            results = adaptive(results, 'control index', self.config)
+        pids_by_day = {}
+        batch = results.fetchmany(self.config['WINDOW_SIZE'])
+        while batch:
+            for pid, day in batch:
+                pid = str(pid)
+                if (days is None or day in days) and pid not in self.excluded:
+                    pids_by_day.setdefault(day, set()).add(pid)
+            batch = results.fetchmany(self.config['WINDOW_SIZE'])
+        return {day: np.array(sorted(pids)) for day, pids in pids_by_day.items()}
+
+    def __len__(self):
+        return sum(len(pids) for pids in self.index.values())
+
+    def sample(self, day, num, exclude=()):
+        '''
+        draw up to `num` distinct eligible PIDs for `day`, never any in `exclude`
+        '''
+        candidates = self.index.get(day)
+        if candidates is None or not num:
+            return []
+        skip = self.used.union(exclude) if self.unique else set(exclude)
+        if skip:
+            candidates = candidates[~np.isin(candidates, list(skip))]
+        picks = self.rng.choice(len(candidates), size=min(num, len(candidates)), replace=False)
+        pids = [str(pid) for pid in candidates[picks]]
+        if self.unique:
+            self.used.update(pids)
+        return pids
+
+    def fetch_rows(self, day, pids):
+        '''
+        the claim-day rows of the sampled `pids` on `day`, in sampling order (one row per PID)
+        returns (result keys, rows)
+        '''
+        if not pids:
+            return [], []
+        results = self.engine.execute("select {} from {} where PID in ('{}') and ANYCLAIM!='0' and DAY = {} and not {} and PROCESS1={}"
+                                      .format(self.columns, self.config['TABLE_NAME'], "','".join(pids), day, self.event_condition, self.dataset))
+        keys = list(results.keys())
+        pid_idx = keys.index('PID')
+        rows_by_pid = {}
+        for row in results:
+            rows_by_pid.setdefault(str(row[pid_idx]), row)
+        return keys, [rows_by_pid[pid] for pid in pids if pid in rows_by_pid]
+
+    def get_state(self):
+        """RNG position and controls used so far, for checkpointing"""
+        return {'rng': self.rng.bit_generator.state, 'used': self.used}
+
+    def set_state(self, state):
+        self.rng.bit_generator.state = state['rng']
+        self.used = set(state['used'])
@@ -2,7 +2,15 @@ import pandas as pd
 import numpy as np
 from sql_engine import initialize
 import argparse
+import csv
+from itertools import groupby
 import json
+import os
+from glob import glob
+
+# tables the checks read; override with 'QA_TABLE_NAME' / 'QA_OUTCOME_TABLE_NAME' in config.json
+QA_TABLE_NAME = 'hicor_tester'
+QA_OUTCOME_TABLE_NAME = 'hicor_outcome_event'
 
 
 def get_sql_counts(engine, ARGS):
@@ -61,6 +69,195 @@ def get_pickled_pandas(ARGS):
     return actual_events, actual_total_pts
 
 
+def get_outcome_conditions(ARGS):
+    """(outcome condition, non-outcome condition) for the queries, matching get_sql_counts"""
+    if len(ARGS.outcome) != 2:
+        return '(IP=1 or ED=1)', '(IP=0 and ED=0)'
+    return '{}=1'.format(ARGS.outcome), '{}=0'.format(ARGS.outcome)
+
+
+def get_pid_subquery(config, ARGS):
+    '''
+    the patients in the pull, as a subquery to join against instead of a literal PID in (...) list
+    (with --max, the PIDs of the first N rows, as in get_sql_counts)
+    '''
+    table = config.get('QA_TABLE_NAME', QA_TABLE_NAME)
+    if ARGS.max:
+        return 'select distinct PID from (select top {} PID from {} where PROCESS1 = {} order by PID, DAY) first_rows'.format(ARGS.max, table, ARGS.dataset)
+    return 'select distinct PID from {} where PROCESS1 = {}'.format(table, ARGS.dataset)
+
+
+class ExpectedEvents():
+    '''
+    expected (PID, DAY) instances of one patient at a time, from rows streamed in (PID, DAY) order:
+    every outcome event day, plus the final non-outcome claim day when it comes after the last outcome event
+    (or the patient has no outcome events) -- the same rule as get_sql_counts
+    '''
+    def __init__(self):
+        self.pid = None
+        self.outcome_days = set()
+        self.final_claim_day = None
+        self.patients = 0
+        self.instances = 0
+
+    def add(self, pid, day, is_outcome, anyclaim=True):
+        """add one row of the current patient; returns the finished instances of the previous patient when `pid` changes"""
+        finished = self.finish() if pid != self.pid else []
+        self.pid = pid
+        if is_outcome:
+            self.outcome_days.add(day)
+        elif anyclaim and (self.final_claim_day is None or day > self.final_claim_day):
+            self.final_claim_day = day
+        return finished
+
+    def finish(self):
+        """instances of the current patient, sorted by DAY"""
+        if self.pid is None:
+            return []
+        days = set(self.outcome_days)
+        if self.final_claim_day is not None and (not days or self.final_claim_day > max(days)):
+            days.add(self.final_claim_day)
+        instances = [(str(self.pid), int(day)) for day in sorted(days)]
+        self.patients += 1
+        self.instances += len(instances)
+        self.pid = None
+        self.outcome_days = set()
+        self.final_claim_day = None
+        return instances
+
+
+def stream_sql_expected(engine, config, ARGS, window_size=10000):
+    '''
+    expected (PID, DAY) instances computed server-side with joins against the patient subquery
+    (no PID in (...) literal), streamed in windows
+    '''
+    table = config.get('QA_TABLE_NAME', QA_TABLE_NAME)
+    outcome_table = config.get('QA_OUTCOME_TABLE_NAME', QA_OUTCOME_TABLE_NAME)
+    outcome, no_outcome = get_outcome_conditions(ARGS)
+    pids = get_pid_subquery(config, ARGS)
+    results = engine.execute(
+        'select e.PID, e.DAY from {outcome_table} e join ({pids}) p on p.PID = e.PID where e.PROCESS1 = {dataset} and {outcome} '
+        'union '
+        'select c.PID, c.DAY from (select t.PID, max(t.DAY) as DAY from {table} t join ({pids}) p on p.PID = t.PID '
+        'where t.PROCESS1 = {dataset} and {no_outcome} and t.ANYCLAIM=1 group by t.PID) c '
+        'left join (select PID, max(DAY) as final_outcome_event from {outcome_table} where PROCESS1 = {dataset} and {outcome} group by PID) o '
+        'on o.PID = c.PID where o.final_outcome_event is null or c.DAY > o.final_outcome_event'
+        .format(outcome_table=outcome_table, table=table, pids=pids, dataset=ARGS.dataset, outcome=outcome, no_outcome=no_outcome))
+    batch = results.fetchmany(window_size)
+    while batch:
+        for pid, day in batch:
+            yield str(pid), int(day)
+        batch = results.fetchmany(window_size)
+
+
+def stream_local_expected(engine, config, ARGS, window_size=10000, patients=None):
+    '''
+    expected (PID, DAY) instances computed locally: the claims table and the outcome event table are each
+    streamed once in (PID, DAY) order and merged patient by patient through ExpectedEvents
+    every patient in the pull is appended to `patients` when a list is given
+    '''
+    table = config.get('QA_TABLE_NAME', QA_TABLE_NAME)
+    outcome_table = config.get('QA_OUTCOME_TABLE_NAME', QA_OUTCOME_TABLE_NAME)
+    outcome, no_outcome = get_outcome_conditions(ARGS)
+    top_x = "top {} ".format(ARGS.max) if ARGS.max else ''
+
+    def _rows(query):
+        results = engine.execute(query)
+        batch = results.fetchmany(window_size)
+        while batch:
+            for row in batch:
+                yield row
+            batch = results.fetchmany(window_size)
+
+    claims = groupby(_rows('select {}PID, DAY, case when {} and ANYCLAIM=1 then 1 else 0 end from {} where PROCESS1 = {} order by PID, DAY'
+                           .format(top_x, no_outcome, table, ARGS.dataset)), key=lambda row: row[0])
+    outcomes = groupby(_rows('select PID, DAY from {} where PROCESS1 = {} and {} order by PID, DAY'
+                             .format(outcome_table, ARGS.dataset, outcome)), key=lambda row: row[0])
+    expected = ExpectedEvents()
+    outcome_pid, outcome_rows = next(outcomes, (None, None))
+    for pid, rows in claims:
+        if patients is not None:
+            patients.append((str(pid),))
+        # outcome events of patients outside the pull are skipped, as with the PID in (...) filter
+        while outcome_pid is not None and outcome_pid < pid:
+            outcome_pid, outcome_rows = next(outcomes, (None, None))
+        for row in rows:
+            expected.add(pid, row[1], False, row[2] == 1)
+        if outcome_pid == pid:
+            for row in outcome_rows:
+                expected.add(pid, row[1], True)
+        for instance in expected.finish():
+            yield instance
+
+
+def stream_sql_patients(engine, config, ARGS, window_size=10000):
+    results = engine.execute(get_pid_subquery(config, ARGS))
+    batch = results.fetchmany(window_size)
+    while batch:
+        for row in batch:
+            yield (str(row[0]),)
+        batch = results.fetchmany(window_size)
+
+
+def stream_actual_events(config, ARGS):
+    '''
+    (PID, DAY) of every output row, reading only the PID and last to_event of each row:
+    a packed or prefix-indexed output directory is memory-mapped, sharded output is read one shard at a time,
+    otherwise the single data pickle is loaded and reduced straight away
+    '''
+    prefix = "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset])
+    if os.path.isdir(prefix + '_packed'):
+        from packed_format import PackedDataset
+        packed = PackedDataset(prefix + '_packed')
+        last_days = np.asarray(packed.days)[np.asarray(packed.visit_offsets)[1:] - 1]
+        for pid, day in zip(packed.pids, last_days.tolist()):
+            yield str(pid).split('_')[0], int(day)
+        return
+    if os.path.isdir(prefix + '_prefix'):
+        from packed_format import PrefixDataset
+        instances = PrefixDataset(prefix + '_prefix')
+        for pid, day in zip(instances.pids, instances.last_days().tolist()):
+            yield str(pid).split('_')[0], int(day)
+        return
+    data_files = sorted(glob(prefix + '_data_[0-9][0-9][0-9][0-9][0-9].pkl')) or [prefix + '_data.pkl']
+    for data_file in data_files:
+        frame = pd.read_pickle(data_file)[['PID', 'to_event']]
+        for pid, to_event in zip(frame['PID'].tolist(), frame['to_event'].tolist()):
+            yield str(pid).split('_')[0], int(to_event[-1])
+
+
+def merge_diff(diff_str, expected, actual, ARGS):
+    '''
+    sorted merge of expected and actual record tuples (each side sorted here, so only the tuples are held):
+    prints matched/mismatched counts like get_diff and streams the mismatches to a csv
+    '''
+    expected = sorted(expected)
+    actual = sorted(actual)
+    print('\n' + str(len(expected)) + ' {} in SQL pull, '.format(diff_str) + str(len(actual)) + ' {} in dataframe'.format(diff_str))
+    columns = ['PID', 'DAY'][:len(expected[0]) if expected else len(actual[0]) if actual else 1]
+    matched = mismatched = 0
+    exp_pos = act_pos = 0
+    with open('mismatched_{}_{}_{}.csv'.format(diff_str, ARGS.dataset, ARGS.outcome), 'w', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(columns + ['Comparison'])
+        while exp_pos < len(expected) or act_pos < len(actual):
+            if act_pos >= len(actual) or (exp_pos < len(expected) and expected[exp_pos] < actual[act_pos]):
+                writer.writerow(list(expected[exp_pos]) + ['IN SQL'])
+                mismatched += 1
+                exp_pos += 1
+            elif exp_pos >= len(expected) or actual[act_pos] < expected[exp_pos]:
+                writer.writerow(list(actual[act_pos]) + ['IN DATAFRAME'])
+                mismatched += 1
+                act_pos += 1
+            else:
+                matched += 1
+                exp_pos += 1
+                act_pos += 1
+    print (str(matched) + ' matched {} in SQL pull and pickled dataframe'.format(diff_str))
+    print (str(mismatched) + ' mismatched {} in SQL pull and pickled dataframe'.format(diff_str))
+    return matched, mismatched
+
+
 def parse_arguments(parser):
     """parameters for the dataset (train, dev, test) to prepare, as well as the appropriate outcome variable"""
     parser.add_argument('--dataset', type=str, default='2',
@@ -71,6 +268,9 @@ def parse_arguments(parser):
                         help="use trusted mssql connection (requires proper sql server drivers)")
     parser.add_argument('--max', type=int, default=None,
                         help="max number of visits to query from main DB")
+    parser.add_argument('--mode', type=str, default='join', choices=['join', 'stream', 'in_list'],
+                        help="expected events from server-side joins, from locally merged ordered table scans, "
+                             "or the original PID in (...) queries (loads the whole output pickle)")
     args = parser.parse_args()
     # slightly different default value here so that we can pick up the pandas output 
     # automatically from hicor_process.py
@@ -103,8 +303,20 @@ if __name__ == '__main__':
         config = json.load(fin)
 
     engine = initialize(config, ARGS.trusted)
-    expected_total_events, expected_total_pts = get_sql_counts(engine, ARGS)
-    actual_events, actual_total_pts = get_pickled_pandas(ARGS)
-    # comment this out if you don't want output files with all mismatched records 
-    get_diff('patients', expected_total_pts, actual_total_pts, ARGS)
-    get_diff('events', expected_total_events, actual_events, ARGS)
\ No newline at end of file
+    if ARGS.mode == 'in_list':
+        expected_total_events, expected_total_pts = get_sql_counts(engine, ARGS)
+        actual_events, actual_total_pts = get_pickled_pandas(ARGS)
+        # comment this out if you don't want output files with all mismatched records 
+        get_diff('patients', expected_total_pts, actual_total_pts, ARGS)
+        get_diff('events', expected_total_events, actual_events, ARGS)
+    else:
+        window_size = config.get('WINDOW_SIZE', 10000)
+        if ARGS.mode == 'join':
+            expected_events = list(stream_sql_expected(engine, config, ARGS, window_size))
+            expected_pts = list(stream_sql_patients(engine, config, ARGS, window_size))
+        else:
+            expected_pts = []
+            expected_events = list(stream_local_expected(engine, config, ARGS, window_size, expected_pts))
+        actual_events = list(stream_actual_events(config, ARGS))
+        merge_diff('patients', expected_pts, set((pid,) for pid, day in actual_events), ARGS)
+        merge_diff('events', expected_events, actual_events, ARGS)
\ No newline at end of file
@@ -0,0 +1,159 @@
+'''
+Streaming feature statistics over the written patient rows
+
+FeatureStats takes the wide rows PID_Counter writes (it has the csv.DictWriter `writerow(s)` interface and can pass
+rows through to another writer) and keeps, per numeric column, the count, mean and variance (merged per block of
+visits, Chan et al.), min and max of the regular values, plus the NULL and sentinel (config['NUMERIC_SENTINELS'],
+defaults to 9999) counts, and per code id the number of visits it appears in. Statistics are over the visits of
+the output rows, i.e. what training sees.
+From those it can z-score numerics to float32 (sentinels and NULLs become 0.0, the mean) and compact the code ids:
+codes seen in at least `min_count` visits get ids 0..K-1 (in original id order), rarer codes share id K ('RARE_CODE')
+'''
+from collections import Counter
+from itertools import chain
+import json
+import numpy as np
+
+DEFAULT_SENTINELS = (9999,)
+RARE_CODE = 'RARE_CODE'
+
+
+class FeatureStats():
+    '''
+    Accumulator for the numerics and codes of written rows; see the module docstring.
+    `code_names` ({code id: code}) names the codes in the report, `writer` (optional) receives every row
+    '''
+    def __init__(self, numeric_cols, code_names=None, sentinels=DEFAULT_SENTINELS, writer=None, block_rows=1000):
+        self.numeric_cols = list(numeric_cols)
+        self.code_names = code_names or {}
+        self.sentinels = np.array(sentinels, dtype=np.float64)
+        self.writer = writer
+        self.block_rows = block_rows
+        num_numerics = len(self.numeric_cols)
+        self.count = np.zeros(num_numerics, dtype=np.int64)
+        self.mean = np.zeros(num_numerics)
+        self.m2 = np.zeros(num_numerics)
+        self.min = np.full(num_numerics, np.inf)
+        self.max = np.full(num_numerics, -np.inf)
+        self.nulls = np.zeros(num_numerics, dtype=np.int64)
+        self.sentinel_counts = np.zeros(num_numerics, dtype=np.int64)
+        self.code_counts = Counter()
+        self.rows = 0
+        self.visits = 0
+        self.block = []
+
+    def __len__(self):
+        return len(self.writer) if self.writer is not None else self.rows
+
+    def writerow(self, row):
+        self.rows += 1
+        for codes in row['codes']:
+            self.code_counts.update(codes)
+        self.block.append(row['numerics'])
+        if len(self.block) >= self.block_rows:
+            self._add_block()
+        if self.writer is not None:
+            self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _values(self, numerics):
+        values = np.array(numerics, dtype=np.float64).reshape(-1, len(self.numeric_cols))
+        nulls = np.isnan(values)
+        sentinels = np.isin(values, self.sentinels)
+        return values, nulls, sentinels
+
+    def _add_block(self):
+        visits = list(chain.from_iterable(self.block))
+        self.block = []
+        if not visits:
+            return
+        values, nulls, sentinels = self._values(visits)
+        valid = ~(nulls | sentinels)
+        self.visits += len(values)
+        self.nulls += nulls.sum(axis=0)
+        self.sentinel_counts += sentinels.sum(axis=0)
+        count = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.where(valid, values, 0).sum(axis=0) / count, 0)
+        m2 = np.where(valid, (values - mean) ** 2, 0).sum(axis=0)
+        # merge the block's mean/M2 into the running ones
+        total = self.count + count
+        delta = mean - self.mean
+        safe_total = np.maximum(total, 1)
+        self.mean = self.mean + delta * count / safe_total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / safe_total
+        self.count = total
+        self.min = np.fmin(self.min, np.where(valid, values, np.inf).min(axis=0))
+        self.max = np.fmax(self.max, np.where(valid, values, -np.inf).max(axis=0))
+
+    def std(self):
+        self._add_block()
+        std = np.sqrt(self.m2 / np.maximum(self.count, 1))
+        return np.where(std > 0, std, 1.0)
+
+    def normalize(self, numerics):
+        """one row's numerics (visits x numerics) z-scored as a float32 array; sentinels and NULLs become 0.0"""
+        values, nulls, sentinels = self._values(numerics)
+        normalized = (values - self.mean) / self._std
+        normalized[nulls | sentinels] = 0.0
+        return normalized.astype(np.float32)
+
+    def code_map(self, min_count):
+        """{old code id: new code id} for codes seen in at least `min_count` visits; the rare id is len(code_map)"""
+        kept = sorted(code for code, count in self.code_counts.items() if count >= min_count)
+        return {code: new_id for new_id, code in enumerate(kept)}
+
+    def compacted_dictionary(self, code_map):
+        """{new code id: code} in the dictionary.pkl format, including the shared rare id"""
+        dictionary = {new_id: self.code_names.get(code, code) for code, new_id in code_map.items()}
+        dictionary[len(code_map)] = RARE_CODE
+        return dictionary
+
+    def prepare(self, normalize=False, min_count=0):
+        """fix the statistics used by `transform` (after the last row is written)"""
+        self._std = self.std()
+        self.normalize_numerics = normalize
+        self.codes = self.code_map(min_count) if min_count else None
+        return self.codes
+
+    def transform(self, numerics, codes):
+        '''
+        one output row's (numerics, codes) as set up by `prepare`: normalized float32 numerics,
+        codes remapped per visit (rare codes collapse to one id per visit)
+        '''
+        if self.normalize_numerics:
+            numerics = self.normalize(numerics)
+        if self.codes is not None:
+            rare = len(self.codes)
+            codes = [list(dict.fromkeys(self.codes.get(code, rare) for code in visit)) for visit in codes]
+        return numerics, codes
+
+    def to_dict(self):
+        std = self.std()
+        numerics = {}
+        for pos, col in enumerate(self.numeric_cols):
+            has_values = self.count[pos] > 0
+            numerics[col] = {'count': int(self.count[pos]),
+                             'nulls': int(self.nulls[pos]),
+                             'sentinels': int(self.sentinel_counts[pos]),
+                             'mean': float(self.mean[pos]) if has_values else None,
+                             'std': float(std[pos]) if has_values else None,
+                             'min': float(self.min[pos]) if has_values else None,
+                             'max': float(self.max[pos]) if has_values else None}
+        return {'rows': self.rows,
+                'visits': self.visits,
+                'sentinel_values': self.sentinels.tolist(),
+                'numerics': numerics,
+                'codes': {str(self.code_names.get(code, code)): count for code, count in self.code_counts.most_common()}}
+
+    def write(self, filepath, code_map=None):
+        report = self.to_dict()
+        if code_map is not None:
+            report['code_map'] = {str(code): new_id for code, new_id in code_map.items()}
+            report['rare_code_id'] = len(code_map)
+        with open(filepath, 'w') as fout:
+            json.dump(report, fout, indent=1)
+        return report
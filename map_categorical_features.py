@@ -9,10 +9,12 @@ import json
 import csv
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import sqlalchemy
 from sqlalchemy import create_engine
 import urllib
 #from sql_engine import initialize
+from sql_engine import initialize_sqlite
 
 def make_engine():
     conn_str = (
@@ -40,30 +42,126 @@ def read_data_dict(filepath=None):
 
 	return datadict
 
-def map_codes_to_ints(datadict, engine,config):
+def distinct_values_per_column(engine, table, col):
 	'''
-	query distinct values of categorical features from full dataset
-	store in pickled dictionary where {integer:string_code_feature}
+	one `select distinct` scan for a single column (the original approach)
+	'''
+	return {col: set(r[0] for r in engine.execute('select distinct {} from {} WHERE {} is not NULL group by {}'.format(col, table, col, col)))}
+
+def distinct_values_unpivot(engine, table, columns):
+	'''
+	distinct values of several Char columns in one server-side scan: the columns are unpivoted into (col, val) pairs
+	(UNPIVOT drops NULLs) and grouped, so only the distinct pairs come back
+	'''
+	casts = ", ".join("cast({0} as nvarchar(4000)) as {0}".format(col) for col in columns)
+	values = {col: set() for col in columns}
+	results = engine.execute('select col, val from (select {} from {}) src unpivot (val for col in ({})) unpvt group by col, val'
+							 .format(casts, table, ", ".join(columns)))
+	for col, val in results:
+		values[col].add(val)
+	return values
+
+def distinct_values_scan(engine, table, columns, window_size=10000):
+	'''
+	distinct values of all columns collected client-side from a single streamed scan
+	(for local SQLite databases such as snapshots, where there is no server to do the grouping)
+	'''
+	values = [set() for col in columns]
+	results = engine.execute('select {} from {}'.format(", ".join(columns), table))
+	batch = results.fetchmany(window_size)
+	while batch:
+		for row in batch:
+			for pos, val in enumerate(row):
+				if val is not None:
+					values[pos].add(val)
+		batch = results.fetchmany(window_size)
+	return dict(zip(columns, values))
+
+def collect_distinct_values(datadict, engines, config, method='unpivot', scans=1):
+	'''
+	{col: set of distinct non-null values} for every non-Binary code column, unioned over `engines`
+	method 'unpivot' splits the Char columns into `scans` groups and runs one UNPIVOT query per group concurrently
+	(other code columns keep their native type through per-column queries), 'per_column' runs the original
+	per-column queries `scans` at a time, and 'scan' reads every code column in one streamed pass per engine
 	'''
-	code_d = {}
-	int_map_count = 1
+	code_cols = [col for col, dtype in datadict.items() if dtype != 'Binary']
+	char_cols = [col for col in code_cols if datadict[col] == 'Char']
+	table = config['TABLE_NAME']
+	values = {col: set() for col in code_cols}
+	for engine in engines:
+		if method == 'scan':
+			jobs = [(distinct_values_scan, (engine, table, code_cols, config.get('WINDOW_SIZE', 10000)))]
+		elif method == 'unpivot':
+			groups = [char_cols[pos::scans] for pos in range(scans) if char_cols[pos::scans]]
+			jobs = [(distinct_values_unpivot, (engine, table, group)) for group in groups]
+			jobs += [(distinct_values_per_column, (engine, table, col)) for col in code_cols if col not in char_cols]
+		else:
+			jobs = [(distinct_values_per_column, (engine, table, col)) for col in code_cols]
+		with ThreadPoolExecutor(max_workers=scans) as pool:
+			for result in pool.map(lambda job: job[0](*job[1]), jobs):
+				for col, col_values in result.items():
+					values[col].update(col_values)
+	return values
+
+def assign_code_ids(datadict, distinct_values, existing=None):
+	'''
+	build {integer:string_code_feature} for Binary columns and every "{col}_{value}" of the other code columns
+	with `existing` (a loaded dictionary), all current ids are kept and only new codes are appended after the highest id,
+	so models trained on the existing dictionary stay valid. new codes are numbered in data dictionary column order,
+	values sorted within a column
+	'''
+	code_d = dict(existing or {})
+	known = set(code_d.values())
+	int_map_count = max(code_d) + 1 if code_d else 1
 	for col, dtype in datadict.items():
 		if (dtype != 'Binary'):
-			results = [r[0] for r in engine.execute('select distinct {} from {} WHERE {} is not NULL group by {}'.format(col, config['TABLE_NAME'], col, col))]
-			for r in results:
-				code_d[int_map_count] = "{}_{}".format(col, r)				
-				int_map_count += 1
+			codes = ["{}_{}".format(col, r) for r in sorted(distinct_values.get(col, ()), key=str)]
 		else:
-			code_d[int_map_count] = col
-			int_map_count += 1
-	with open('./dictionary_{}.pkl'.format(int_map_count-1), 'wb') as code_map:
+			codes = [col]
+		for code in codes:
+			if code not in known:
+				code_d[int_map_count] = code
+				known.add(code)
+				int_map_count += 1
+	return code_d
+
+def map_codes_to_ints(datadict, engine, config, method='per_column', scans=1, existing_path=None):
+	'''
+	query distinct values of categorical features from full dataset
+	store in pickled dictionary where {integer:string_code_feature}
+	`engine` may also be a list of engines (e.g. several local SQLite files), whose values are unioned
+	with `existing_path`, the dictionary there is extended in place of being renumbered from scratch
+	'''
+	existing = None
+	if existing_path:
+		with open(existing_path, 'rb') as fin:
+			existing = pickle.load(fin)
+	engines = engine if isinstance(engine, (list, tuple)) else [engine]
+	distinct_values = collect_distinct_values(datadict, engines, config, method, scans)
+	code_d = assign_code_ids(datadict, distinct_values, existing)
+	if existing is not None:
+		print("Kept {} existing codes, added {} new codes".format(len(existing), len(code_d) - len(existing)))
+	dict_path = './dictionary_{}.pkl'.format(max(code_d) if code_d else 0)
+	with open(dict_path, 'wb') as code_map:
 		pickle.dump(code_d, code_map)
+	print("Code dictionary written to {} ({} codes)".format(dict_path, len(code_d)))
+	return code_d
 
 def parse_arguments(parser):
     """single argument for whether or not to use the sql trusted connection or the user login info in config.json"""
     parser.add_argument('--trusted', action='store_true',
                         help="use trusted mssql connection (requires proper sql server drivers)")
+    parser.add_argument('--method', type=str, default='unpivot', choices=['unpivot', 'per_column', 'scan'],
+                        help="one UNPIVOT scan per column group, the original query per column, or a single client-side scan")
+    parser.add_argument('--scans', type=int, default=1,
+                        help="number of concurrent queries (column groups for unpivot, columns at a time for per_column)")
+    parser.add_argument('--sqlite', type=str, nargs='+', default=None,
+                        help="read from local SQLite file(s) (e.g. snapshots) instead of the server; implies --method scan")
+    parser.add_argument('--incremental', type=str, nargs='?', const='./dictionary.pkl', default=None,
+                        help="keep every id of this existing dictionary and append new codes only")
     args = parser.parse_args()
+    if args.sqlite:
+        args.method = 'scan'
     return args
 
 if __name__ == '__main__':
@@ -72,6 +170,6 @@ if __name__ == '__main__':
 
 	with open('./config.json') as fin:
 		config = json.load(fin)
-	engine = make_engine()
+	engine = [initialize_sqlite(path) for path in ARGS.sqlite] if ARGS.sqlite else make_engine()
 	datadict = read_data_dict()
-	map_codes_to_ints(datadict, engine, config)
\ No newline at end of file
+	map_codes_to_ints(datadict, engine, config, ARGS.method, ARGS.scans, ARGS.incremental)
\ No newline at end of file
@@ -0,0 +1,169 @@
+""" Writers that PID_Counter.write_all_rows can target in place of the StringIO csv.DictWriter """
+from array import array
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import pandas as pd
+
+
+class ColumnarWriter():
+    '''
+    Appends wide patient rows straight into typed column builders
+    (str PIDs, list-valued numerics/codes/to_event, int targets) and builds the final DataFrame
+    without the csv text round trip. Exposes the `writerow(s)` interface of csv.DictWriter
+    '''
+    def __init__(self, fieldnames):
+        self.fieldnames = list(fieldnames)
+        self.pids = []
+        self.targets = array('q')
+        self.list_columns = {name: [] for name in self.fieldnames if name not in ('PID', 'target')}
+
+    def __len__(self):
+        return len(self.pids)
+
+    def writerow(self, row):
+        # PIDs are stored the way the csv path writes them (str), so split-on-event ids like '123_2' stay comparable
+        self.pids.append(str(row['PID']))
+        self.targets.append(int(row['target']))
+        for name, values in self.list_columns.items():
+            values.append(row.get(name))
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def to_dataframe(self):
+        data = {}
+        for name in self.fieldnames:
+            if name == 'PID':
+                data[name] = pd.Series(self.pids, dtype=object)
+            elif name == 'target':
+                data[name] = pd.Series(self.targets, dtype='int64')
+            else:
+                data[name] = pd.Series(self.list_columns[name], dtype=object)
+        return pd.DataFrame(data, columns=self.fieldnames)
+
+
+class CountingWriter():
+    '''
+    Passes rows through to `writer` while counting them, the distinct patients (PID before any '_<event>' suffix)
+    and the positive targets, for the inline --qa summary
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = 0
+        self.positives = 0
+        self.patients = set()
+
+    def writerow(self, row):
+        self.rows += 1
+        self.positives += 1 if int(row['target']) == 1 else 0
+        self.patients.add(str(row['PID']).split('_')[0])
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+class ShardedWriter():
+    '''
+    Streams wide patient rows to disk with bounded memory.
+    Rows are buffered up to `shard_size`, sorted by visit count (most visits first, ties in arrival order)
+    and spilled to a run file as pickled chunks of `chunk_size` rows. `finalize` k-way merges the runs into
+    globally sorted data/target shard files, holding at most one chunk per run plus one output shard in memory
+    '''
+    def __init__(self, fieldnames, shard_dir=None, shard_size=100000, chunk_size=1000):
+        self.fieldnames = list(fieldnames)
+        self.codes_pos = self.fieldnames.index('codes')
+        self.shard_size = shard_size
+        self.chunk_size = chunk_size
+        self.owns_shard_dir = not shard_dir
+        self.shard_dir = shard_dir or tempfile.mkdtemp(prefix='hicor_shards_')
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.buffer = []
+        self.run_files = []
+        self.row_count = 0
+
+    def __len__(self):
+        return self.row_count
+
+    def writerow(self, row):
+        # records are (arrival row number, visit count, field values...)
+        values = tuple(str(row['PID']) if name == 'PID' else row.get(name) for name in self.fieldnames)
+        self.buffer.append((self.row_count, len(values[self.codes_pos])) + values)
+        self.row_count += 1
+        if len(self.buffer) >= self.shard_size:
+            self._spill()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _spill(self):
+        if not self.buffer:
+            return
+        self.buffer.sort(key=lambda record: -record[1])
+        run_file = os.path.join(self.shard_dir, 'run_{:05d}.pkl'.format(len(self.run_files)))
+        with open(run_file, 'wb') as fout:
+            for offset in range(0, len(self.buffer), self.chunk_size):
+                pickle.dump(self.buffer[offset:offset + self.chunk_size], fout, protocol=pickle.HIGHEST_PROTOCOL)
+        self.run_files.append(run_file)
+        self.buffer = []
+
+    @staticmethod
+    def _read_run(run_file):
+        with open(run_file, 'rb') as fin:
+            while True:
+                try:
+                    chunk = pickle.load(fin)
+                except EOFError:
+                    return
+                for record in chunk:
+                    yield record
+
+    def _write_shard(self, records, data_file, target_file):
+        # same layout as the in-memory path: data keeps visit_num, target is popped into its own frame
+        index = [record[0] for record in records]
+        df = pd.DataFrame({name: pd.Series([record[pos + 2] for record in records], index=index,
+                                           dtype='int64' if name == 'target' else object)
+                           for pos, name in enumerate(self.fieldnames)}, columns=self.fieldnames)
+        df['visit_num'] = pd.Series([record[1] for record in records], index=index, dtype='int64')
+        target_df = pd.DataFrame(df.pop('target'))
+        df.to_pickle(data_file)
+        target_df.to_pickle(target_file)
+
+    def finalize(self, data_file, target_file, merge_shards=False):
+        '''
+        merge the sorted runs into `data_file`/`target_file` shards named *_00000.pkl, *_00001.pkl, ...
+        (each shard_size rows, sorted by visit_num across shards), or into the single usual files when `merge_shards` is set
+        returns the list of (data file, target file) pairs written
+        '''
+        self._spill()
+        merged = heapq.merge(*[self._read_run(run_file) for run_file in self.run_files], key=lambda record: -record[1])
+        written = []
+        shard = []
+        for record in merged:
+            shard.append(record)
+            if len(shard) >= self.shard_size and not merge_shards:
+                written.append(self._finish_shard(shard, data_file, target_file, len(written)))
+                shard = []
+        if shard or not written:
+            if merge_shards:
+                self._write_shard(shard, data_file, target_file)
+                written.append((data_file, target_file))
+            else:
+                written.append(self._finish_shard(shard, data_file, target_file, len(written)))
+        for run_file in self.run_files:
+            os.remove(run_file)
+        self.run_files = []
+        if self.owns_shard_dir:
+            shutil.rmtree(self.shard_dir, ignore_errors=True)
+        return written
+
+    def _finish_shard(self, shard, data_file, target_file, shard_num):
+        shard_files = tuple("{}_{:05d}.pkl".format(os.path.splitext(path)[0], shard_num) for path in (data_file, target_file))
+        self._write_shard(shard, *shard_files)
+        return shard_files
@@ -0,0 +1,327 @@
+'''
+Packed ragged-array (CSR-style) storage for RETAIN sequences
+
+A packed dataset is a directory of .npy files (each can be memory-mapped):
+  codes.npy           int32    all code ids of all visits, concatenated
+  code_offsets.npy    int64    visit v's codes are codes[code_offsets[v]:code_offsets[v+1]]
+  numerics.npy        float32  (total visits, number of numerics); NULL numerics are NaN
+  days.npy            int32    DAY ('to_event') of every visit
+  visit_offsets.npy   int64    patient p's visits are visit_offsets[p]:visit_offsets[p+1]
+  targets.npy         int8     one target per patient row
+  pids.npy            unicode  one PID per patient row (split-on-event ids such as '123_2' included)
+  sort_order.npy      int64    patient rows by visit count, most visits first (ties in extraction order)
+
+A prefix-indexed dataset (PrefixWriter / PrefixDataset) stores each distinct visit sequence once and every
+output row as an instance over it, for --day_instance and multi-event patients whose rows are prefixes of
+the same history. codes, code_offsets, numerics and days are as above, plus:
+  sequence_starts.npy int64    first visit of each stored sequence (a sequence's visits are contiguous)
+  sequences.npy       int64    the sequence of each instance (output row)
+  cuts.npy            int64    the instance's visits are the first `cut` visits of its sequence...
+  extra_visits.npy    int64    ...followed by this visit (e.g. the partial event day), or -1 for none
+  targets.npy, pids.npy, sort_order.npy   per instance, as above
+'''
+from array import array
+import os
+import numpy as np
+import pandas as pd
+
+PACKED_ARRAYS = ('codes', 'code_offsets', 'numerics', 'days', 'visit_offsets', 'targets', 'pids', 'sort_order')
+PREFIX_ARRAYS = ('codes', 'code_offsets', 'numerics', 'days', 'sequence_starts', 'sequences', 'cuts', 'extra_visits',
+                 'targets', 'pids', 'sort_order')
+
+
+class PackedWriter():
+    '''
+    Writer with the csv.DictWriter `writerow(s)` interface that packs wide patient rows
+    into flat typed buffers as PID_Counter produces them
+    '''
+    def __init__(self, num_numerics):
+        self.num_numerics = num_numerics
+        self.codes = array('i')
+        self.code_offsets = array('q', [0])
+        self.numerics = array('f')
+        self.days = array('i')
+        self.visit_offsets = array('q', [0])
+        self.targets = array('b')
+        self.pids = []
+
+    def __len__(self):
+        return len(self.pids)
+
+    def _add_visits(self, visit_codes, visit_numerics, visit_days):
+        nan = float('nan')
+        for codes, numerics in zip(visit_codes, visit_numerics):
+            self.codes.extend(codes)
+            self.code_offsets.append(len(self.codes))
+            if len(numerics) != self.num_numerics:
+                raise ValueError("Expected {} numerics per visit, got {}".format(self.num_numerics, len(numerics)))
+            self.numerics.extend(nan if val is None else float(val) for val in numerics)
+        self.days.extend(int(day) for day in visit_days)
+
+    def writerow(self, row):
+        self._add_visits(row['codes'], row['numerics'], row['to_event'])
+        self.visit_offsets.append(len(self.code_offsets) - 1)
+        self.targets.append(int(row['target']))
+        self.pids.append(str(row['PID']))
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def save(self, dirpath):
+        '''
+        write the packed arrays as .npy files under dirpath (created if needed)
+        '''
+        visit_offsets = np.frombuffer(self.visit_offsets, dtype=np.int64)
+        arrays = self._visit_arrays()
+        arrays.update({'visit_offsets': visit_offsets,
+                       'targets': np.frombuffer(self.targets, dtype=np.int8),
+                       'pids': np.array(self.pids, dtype=np.str_),
+                       'sort_order': np.argsort(-np.diff(visit_offsets), kind='stable')})
+        return _save_arrays(dirpath, arrays)
+
+    def _visit_arrays(self):
+        return {'codes': np.frombuffer(self.codes, dtype=np.int32),
+                'code_offsets': np.frombuffer(self.code_offsets, dtype=np.int64),
+                'numerics': np.frombuffer(self.numerics, dtype=np.float32).reshape(-1, self.num_numerics),
+                'days': np.frombuffer(self.days, dtype=np.int32)}
+
+
+def _save_arrays(dirpath, arrays):
+    os.makedirs(dirpath, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(dirpath, '{}.npy'.format(name)), values)
+    return dirpath
+
+
+def _base_pid(pid):
+    # split-on-event rows are namespaced '<PID>_<event number>'
+    return str(pid).split('_')[0]
+
+
+class PrefixWriter(PackedWriter):
+    '''
+    Writer with the csv.DictWriter `writerow(s)` interface for the prefix-indexed layout (see module docstring).
+    Consecutive rows of the same patient are buffered; when the patient changes, its rows are matched, longest
+    first, against the visit sequences already stored for it: a row equal to the first `cut` visits of one
+    (optionally plus one different final visit, such as a partial event day) only costs an instance entry,
+    anything else is stored as a new sequence. Matching compares visit contents, so the output always expands
+    back to exactly the rows written; rows of a patient that are not written consecutively just share less
+    '''
+    def __init__(self, num_numerics):
+        super().__init__(num_numerics)
+        self.sequence_starts = array('q')
+        self.sequences = array('q')
+        self.cuts = array('q')
+        self.extra_visits = array('q')
+        self.visit_counts = array('q')
+        self.group = []
+        self.group_pid = None
+        self.rows_written = 0
+
+    def __len__(self):
+        return self.rows_written
+
+    def writerow(self, row):
+        pid = _base_pid(row['PID'])
+        if pid != self.group_pid:
+            self._flush()
+            self.group_pid = pid
+        self.group.append(row)
+        self.rows_written += 1
+
+    def _add_visit(self, row, pos):
+        self._add_visits(row['codes'][pos:pos + 1], row['numerics'][pos:pos + 1], row['to_event'][pos:pos + 1])
+        return len(self.code_offsets) - 2
+
+    @staticmethod
+    def _is_prefix(row, sequence, num_visits):
+        return all(row[col][:num_visits] == sequence[col][:num_visits] for col in ('to_event', 'codes', 'numerics'))
+
+    def _match(self, row, sequences):
+        '''
+        (sequence id, cut, extra visit) of a stored sequence `row` is a prefix of, or None
+        '''
+        num_visits = len(row['codes'])
+        for sequence_id, sequence in sequences:
+            if num_visits > len(sequence['codes']):
+                continue
+            if self._is_prefix(row, sequence, num_visits):
+                return sequence_id, num_visits, -1
+            if self._is_prefix(row, sequence, num_visits - 1):
+                return sequence_id, num_visits - 1, self._add_visit(row, num_visits - 1)
+        return None
+
+    def _flush(self):
+        rows = self.group
+        self.group = []
+        placements = [None] * len(rows)
+        sequences = []
+        for pos in sorted(range(len(rows)), key=lambda pos: -len(rows[pos]['codes'])):
+            row = rows[pos]
+            placements[pos] = self._match(row, sequences)
+            if placements[pos] is None:
+                self.sequence_starts.append(len(self.code_offsets) - 1)
+                self._add_visits(row['codes'], row['numerics'], row['to_event'])
+                sequences.append((len(self.sequence_starts) - 1, row))
+                placements[pos] = (sequences[-1][0], len(row['codes']), -1)
+        for row, (sequence_id, cut, extra_visit) in zip(rows, placements):
+            self.sequences.append(sequence_id)
+            self.cuts.append(cut)
+            self.extra_visits.append(extra_visit)
+            self.visit_counts.append(len(row['codes']))
+            self.targets.append(int(row['target']))
+            self.pids.append(str(row['PID']))
+
+    def save(self, dirpath):
+        self._flush()
+        arrays = self._visit_arrays()
+        arrays.update({'sequence_starts': np.frombuffer(self.sequence_starts, dtype=np.int64),
+                       'sequences': np.frombuffer(self.sequences, dtype=np.int64),
+                       'cuts': np.frombuffer(self.cuts, dtype=np.int64),
+                       'extra_visits': np.frombuffer(self.extra_visits, dtype=np.int64),
+                       'targets': np.frombuffer(self.targets, dtype=np.int8),
+                       'pids': np.array(self.pids, dtype=np.str_),
+                       'sort_order': np.argsort(-np.frombuffer(self.visit_counts, dtype=np.int64), kind='stable')})
+        return _save_arrays(dirpath, arrays)
+
+
+class PackedDataset():
+    '''
+    Read side of the packed format. Arrays are memory-mapped by default, so batches can be
+    streamed without loading (or unpickling) the whole dataset
+    '''
+    def __init__(self, dirpath, mmap_mode='r'):
+        self.dirpath = dirpath
+        for name in PACKED_ARRAYS:
+            setattr(self, name, np.load(os.path.join(dirpath, '{}.npy'.format(name)), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def visit_counts(self):
+        return np.diff(self.visit_offsets)
+
+    def patient(self, idx):
+        '''
+        return (PID, list of per-visit code arrays, numerics array, days array, target) for one patient row
+        '''
+        start, end = self.visit_offsets[idx], self.visit_offsets[idx + 1]
+        code_offsets = self.code_offsets[start:end + 1]
+        visit_codes = [self.codes[code_offsets[v]:code_offsets[v + 1]] for v in range(end - start)]
+        return self.pids[idx], visit_codes, self.numerics[start:end], self.days[start:end], self.targets[idx]
+
+    def iter_batches(self, batch_size, sorted_by_visits=True):
+        '''
+        yield lists of `patient` tuples, batch_size patient rows at a time
+        '''
+        order = self.sort_order if sorted_by_visits else np.arange(len(self))
+        for offset in range(0, len(order), batch_size):
+            yield [self.patient(idx) for idx in order[offset:offset + batch_size]]
+
+    def to_dataframe(self, sorted_by_visits=True):
+        '''
+        rebuild the usual (data, target) DataFrames: PID, numerics, codes, to_event, visit_num / target
+        numerics come back as floats (NaN for NULLs)
+        '''
+        codes = np.asarray(self.codes).tolist()
+        code_offsets = np.asarray(self.code_offsets).tolist()
+        numerics = np.asarray(self.numerics).tolist()
+        days = np.asarray(self.days).tolist()
+        visit_offsets = np.asarray(self.visit_offsets).tolist()
+        rows = {'PID': [], 'numerics': [], 'codes': [], 'to_event': []}
+        for idx in range(len(self)):
+            start, end = visit_offsets[idx], visit_offsets[idx + 1]
+            rows['PID'].append(str(self.pids[idx]))
+            rows['numerics'].append(numerics[start:end])
+            rows['codes'].append([codes[code_offsets[v]:code_offsets[v + 1]] for v in range(start, end)])
+            rows['to_event'].append(days[start:end])
+        df = pd.DataFrame({name: pd.Series(values, dtype=object) for name, values in rows.items()})
+        df['target'] = np.asarray(self.targets, dtype=np.int64)
+        df['visit_num'] = self.visit_counts()
+        if sorted_by_visits:
+            df = df.iloc[np.asarray(self.sort_order)]
+        target_df = pd.DataFrame(df.pop('target'))
+        return df, target_df
+
+
+class PrefixDataset():
+    '''
+    Read side of the prefix-indexed layout: instances are expanded lazily, one at a time or per batch,
+    with the same `patient` / `iter_batches` / `to_dataframe` interface as PackedDataset
+    '''
+    def __init__(self, dirpath, mmap_mode='r'):
+        self.dirpath = dirpath
+        for name in PREFIX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(dirpath, '{}.npy'.format(name)), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def visit_counts(self):
+        return np.asarray(self.cuts) + (np.asarray(self.extra_visits) >= 0)
+
+    def visit_ids(self, idx):
+        """ indexes into the visit arrays of instance `idx`'s visits """
+        start = self.sequence_starts[self.sequences[idx]]
+        visit_ids = np.arange(start, start + self.cuts[idx])
+        if self.extra_visits[idx] >= 0:
+            visit_ids = np.append(visit_ids, self.extra_visits[idx])
+        return visit_ids
+
+    def last_days(self):
+        """ DAY of the final visit of every instance """
+        extra_visits = np.asarray(self.extra_visits)
+        last_visits = np.asarray(self.sequence_starts)[np.asarray(self.sequences)] + np.asarray(self.cuts) - 1
+        return np.asarray(self.days)[np.where(extra_visits >= 0, extra_visits, last_visits)]
+
+    def patient(self, idx):
+        '''
+        return (PID, list of per-visit code arrays, numerics array, days array, target) for one instance
+        '''
+        visit_ids = self.visit_ids(idx)
+        visit_codes = [self.codes[self.code_offsets[v]:self.code_offsets[v + 1]] for v in visit_ids]
+        return self.pids[idx], visit_codes, self.numerics[visit_ids], self.days[visit_ids], self.targets[idx]
+
+    def iter_batches(self, batch_size, sorted_by_visits=True):
+        '''
+        yield lists of `patient` tuples, batch_size instances at a time
+        '''
+        order = self.sort_order if sorted_by_visits else np.arange(len(self))
+        for offset in range(0, len(order), batch_size):
+            yield [self.patient(idx) for idx in order[offset:offset + batch_size]]
+
+    def to_dataframe(self, sorted_by_visits=True):
+        '''
+        expand every instance into the usual (data, target) DataFrames (see PackedDataset.to_dataframe)
+        '''
+        codes = np.asarray(self.codes).tolist()
+        code_offsets = np.asarray(self.code_offsets).tolist()
+        numerics = np.asarray(self.numerics).tolist()
+        days = np.asarray(self.days).tolist()
+        visit_codes = [codes[code_offsets[v]:code_offsets[v + 1]] for v in range(len(days))]
+        sequence_starts = np.asarray(self.sequence_starts).tolist()
+        rows = {'PID': [], 'numerics': [], 'codes': [], 'to_event': []}
+        for pid, sequence, cut, extra_visit in zip(self.pids.tolist(), np.asarray(self.sequences).tolist(),
+                                                   np.asarray(self.cuts).tolist(), np.asarray(self.extra_visits).tolist()):
+            start = sequence_starts[sequence]
+            visit_ids = list(range(start, start + cut)) + ([extra_visit] if extra_visit >= 0 else [])
+            rows['PID'].append(pid)
+            rows['numerics'].append([numerics[v] for v in visit_ids])
+            rows['codes'].append([visit_codes[v] for v in visit_ids])
+            rows['to_event'].append([days[v] for v in visit_ids])
+        df = pd.DataFrame({name: pd.Series(values, dtype=object) for name, values in rows.items()})
+        df['target'] = np.asarray(self.targets, dtype=np.int64)
+        df['visit_num'] = self.visit_counts()
+        if sorted_by_visits:
+            df = df.iloc[np.asarray(self.sort_order)]
+        target_df = pd.DataFrame(df.pop('target'))
+        return df, target_df
+
+
+def load_packed(dirpath, mmap_mode='r'):
+    return PackedDataset(dirpath, mmap_mode)
+
+
+def load_prefix(dirpath, mmap_mode='r'):
+    return PrefixDataset(dirpath, mmap_mode)
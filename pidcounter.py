@@ -1,4 +1,3 @@
-from copy import deepcopy
 from math import isclose
 from operator import itemgetter
 
@@ -70,31 +69,34 @@ class PID_Counter():
     def _dupe_events(self, day=None):
         '''
         Use the total number of encountered events to create 
-        a duplicate of all rows to this point with a namespace-separated PID
-        This is saved to a list-of-lists to be written out at a later point
-        >>> pc = PID_Counter(event_type='ED')
+        a view of all rows to this point with a namespace-separated PID
+        The view is a (new PID, end index into pid_rows, partial_event visit or None) tuple; 
+        rows are only copied out of the shared pid_rows buffer when converting to the wide representation
+        >>> pc = PID_Counter()
         >>> pc.pid = 1
-        >>> pc.pid_event_count['ED'] = 1
+        >>> pc.pid_event_count = 1
         >>> pc.pid_rows.append({'PID': 1, 'ED':0, 'IP':1, 'DAY':1 })
         >>> pc.pid_rows.append({'PID': 1, 'ED':1, 'IP':1, 'DAY':2 })
         >>> pc.pid_rows.append({'PID': 1, 'ED':0, 'IP':1, 'DAY':3 })
         >>> pc._dupe_events()
-        >>> from  pprint import pprint
-        >>> pprint(pc.duped_rows)
-        [[{'DAY': 1, 'ED': 0, 'IP': 1, 'PID': '1_1'},
-          {'DAY': 2, 'ED': 1, 'IP': 1, 'PID': '1_1'},
-          {'DAY': 3, 'ED': 0, 'IP': 1, 'PID': '1_1'}]]
+        >>> pc.duped_rows
+        [('1_1', 3, None)]
         
         '''
         new_PID = "_".join([str(self.pid), str(self.pid_event_count)])
-        duped_rows = deepcopy(self.pid_rows)
         # add partial_event visit row for event day
-        if day and self.partial_events.get(day):
-            duped_rows.append(self.partial_events[day])
-        #set new PID for duped rows
-        for row in duped_rows:
-            row['PID'] = new_PID
-        self.duped_rows.append(duped_rows)
+        partial_visit = self.partial_events.get(day) if day else None
+        self.duped_rows.append((new_PID, len(self.pid_rows), partial_visit))
+
+    def _view_rows(self, view):
+        '''
+        materialize a duped event view into (new PID, list of visit rows)
+        '''
+        new_PID, end, partial_visit = view
+        rows = self.pid_rows[:end]
+        if partial_visit:
+            rows.append(partial_visit)
+        return new_PID, rows
 
     def convert_rows_to_wide_rep(self):
         if self.is_wide_version is True or not self.pid_rows:
@@ -131,15 +133,16 @@ class PID_Counter():
             return row
 
 
-        #convert vanilla rows
-        self.pid_rows = _create_condensed_row(self.pid, self.pid_rows, self.prev_event_value)
-        #convert duped rows (a list of lists)
+        #convert duped rows (views over pid_rows, so these go first)
         condensed_duped_rows = []
-        for duped_pid_chunk in self.duped_rows:
+        for view in self.duped_rows:
+            duped_pid, duped_pid_chunk = self._view_rows(view)
             if not duped_pid_chunk:
                 continue
-            duped_row = _create_condensed_row(duped_pid_chunk[0]['PID'], duped_pid_chunk, 1)
+            duped_row = _create_condensed_row(duped_pid, duped_pid_chunk, 1)
             condensed_duped_rows.append(duped_row)
+        #convert vanilla rows
+        self.pid_rows = _create_condensed_row(self.pid, self.pid_rows, self.prev_event_value)
             
         self.duped_rows = condensed_duped_rows
         self.is_wide_version = True
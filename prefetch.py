@@ -0,0 +1,93 @@
+""" Background prefetch of fetchmany windows, so DB I/O overlaps with encoding and PID_Counter work """
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+
+
+class PrefetchingCursor():
+    '''
+    Wraps a result set: a background thread keeps calling fetchmany(window_size) and puts the windows
+    on a bounded queue (at most `depth` windows ahead), while the main loop takes them off with `fetchmany`.
+    Counters for tuning WINDOW_SIZE:
+      fetch_secs           time the background thread spent inside fetchmany
+      producer_stall_secs  time a fetched window waited for room in the queue (encoding is the bottleneck)
+      consumer_stall_secs  time the main loop waited for a window (fetching is the bottleneck)
+      queue depth          windows already waiting each time the main loop asked for one
+    the DBAPI connection is read from the background thread only (pyodbc/pymssql allow this;
+    sqlite engines need connect_args={'check_same_thread': False})
+    '''
+    def __init__(self, results, window_size, depth=2):
+        self.results = results
+        self.window_size = window_size
+        self.depth = depth
+        self.queue = Queue(maxsize=max(1, depth))
+        self.fetch_secs = 0.0
+        self.producer_stall_secs = 0.0
+        self.consumer_stall_secs = 0.0
+        self.batches = 0
+        self.rows = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.finished = False
+        self.thread = Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def keys(self):
+        return self.results.keys()
+
+    def _produce(self):
+        try:
+            while True:
+                start = perf_counter()
+                batch = self.results.fetchmany(self.window_size)
+                self.fetch_secs += perf_counter() - start
+                start = perf_counter()
+                self.queue.put(batch)
+                self.producer_stall_secs += perf_counter() - start
+                if not batch:
+                    return
+        except Exception as err:
+            # handed to the main thread and re-raised from fetchmany
+            self.queue.put(err)
+
+    def fetchmany(self, size=None):
+        '''
+        next prefetched window (`size` is ignored; windows are always window_size rows); [] once exhausted
+        '''
+        if self.finished:
+            return []
+        depth = self.queue.qsize()
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+        start = perf_counter()
+        batch = self.queue.get()
+        self.consumer_stall_secs += perf_counter() - start
+        if isinstance(batch, Exception):
+            self.finished = True
+            raise batch
+        if not batch:
+            self.finished = True
+            return []
+        self.batches += 1
+        self.rows += len(batch)
+        return batch
+
+    def stats(self):
+        requests = self.batches + (1 if self.finished else 0)
+        return {'window_size': self.window_size,
+                'depth': self.depth,
+                'batches': self.batches,
+                'rows': self.rows,
+                'fetch_secs': round(self.fetch_secs, 3),
+                'producer_stall_secs': round(self.producer_stall_secs, 3),
+                'consumer_stall_secs': round(self.consumer_stall_secs, 3),
+                'avg_queue_depth': round(self.depth_total / requests, 2) if requests else 0,
+                'max_queue_depth': self.max_depth}
+
+    def report(self, label='fetch'):
+        stats = self.stats()
+        return ("Prefetch ({}): {} rows in {} windows of {}; fetch {}s, waiting on DB {}s, waiting on encoding {}s, "
+                "queue depth avg {} / max {} (of {})".format(label, stats['rows'], stats['batches'], stats['window_size'],
+                                                            stats['fetch_secs'], stats['consumer_stall_secs'],
+                                                            stats['producer_stall_secs'], stats['avg_queue_depth'],
+                                                            stats['max_queue_depth'], stats['depth']))
@@ -1,18 +1,41 @@
 """ Script for pulling HICOR data and converting it to RETAIN-compatible pickle files """
+from adaptive_window import adaptive, reset_windows, window_report
 import argparse
 import ast
+from batch_index import write_batch_index
+from bisect import bisect_left
+from checkpoint import Checkpoint
 from collections import defaultdict
+from control_sampler import ControlSampler
+from copy import copy
+import cProfile
 import csv
+from data_qa_checks import ExpectedEvents
 from datetime import datetime
+from feature_stats import DEFAULT_SENTINELS, RARE_CODE, FeatureStats
+from functools import partial
+import glob
+import hashlib
 from io import StringIO
 import json
+from multiprocessing import Pool
+import os
 import pandas as pd
 import pickle
 from pidcounter import PID_Counter
-from sql_engine import initialize
+from prefetch import PrefetchingCursor
+import pstats
+from query_builder import SparseRows, select_list, sparse_flags_query, used_columns
+from run_metrics import get_metrics, start_metrics, stop_metrics
+from snapshot_cache import connect_snapshots, dictionary_hash, ensure_snapshots
+from sql_engine import initialize, stream_tuples
 from sqlalchemy import create_engine
 from tqdm import tqdm
 import urllib
+from output_writers import ColumnarWriter, CountingWriter, ShardedWriter
+from packed_format import PackedWriter, PrefixWriter
+from visit_encoder import VisitEncoder, compile_code_tables
+from watermark import DELTA_PID_CHUNK, changed_pids, load_watermarks, read_watermarks, save_watermarks, source_pid
 
 
 CONVERTERS = {"numerics": ast.literal_eval, "codes": ast.literal_eval, "to_event": ast.literal_eval}
@@ -31,9 +54,12 @@ def make_engine():
 
 class DataDictionary():
     def __init__(self, default_datadict=True, default_codes=True):
+        self._code_tables = None
+        self._encoders = {}
         self.code_cols = {}
         self.numeric_cols = []
         self.drop_cols = []
+        self.columns = []
         if default_datadict:
             self.read_data_dict('./data_dictionary.csv')
         self.code_mappings = {}
@@ -44,17 +70,36 @@ class DataDictionary():
         with open(filepath, "r") as fin:
             reader = csv.DictReader(fin)
             for row in reader:
+                self.columns.append(row['Name'])
                 if (row['DataTreatment'] == 'Code'):
                     self.code_cols[row['Name']] = (row['DataTreatment'], row['DataType'], row['Temporal'])
                 elif (row['DataTreatment'] == 'Numeric'):
                     self.numeric_cols.append(row['Name'])
                 else:
                     self.drop_cols.append(row['Name'])
+        self._code_tables = None
+        self._encoders = {}
 
     def read_code_mapping(self, filepath):
         with open(filepath, "rb") as fin:
             code_map = pickle.load(fin)
         self.code_mappings = {v:k for k,v in code_map.items()}
+        self._code_tables = None
+        self._encoders = {}
+
+    def get_encoder(self, columns, config):
+        """
+        return a compiled VisitEncoder for the given result-set column order
+        encoders (and the value->code-id tables they share) are cached, so this is cheap to call per query
+        """
+        key = tuple(columns)
+        encoder = self._encoders.get(key)
+        if encoder is None:
+            if self._code_tables is None:
+                self._code_tables = compile_code_tables(self)
+            encoder = VisitEncoder(self, key, config, self._code_tables)
+            self._encoders[key] = encoder
+        return encoder
 
 
 def build_visit_dict(rowdict, datadict, error_cols, config):
@@ -93,6 +138,49 @@ def build_visit_dict(rowdict, datadict, error_cols, config):
     return newvisit
 
 
+def adaptive_rows(results, name, config, ARGS={}):
+    """with --adaptive_window, fetch from `results` in windows sized for its kind of query (see adaptive_window.py)"""
+    if not getattr(ARGS, 'adaptive_window', False):
+        return results
+    return adaptive(results, name, config)
+
+
+def prefetch_windows(results, config, ARGS={}, name='scan'):
+    """
+    with --prefetch N, fetch windows on a background thread up to N windows ahead of the encoding loop
+    """
+    # fetch timings/bytes are measured on the raw cursor, i.e. on the prefetch thread with --prefetch
+    results = adaptive_rows(get_metrics().metered(results), name, config, ARGS)
+    if not ARGS.prefetch:
+        return results
+    return PrefetchingCursor(results, config['WINDOW_SIZE'], ARGS.prefetch)
+
+
+def execute_scan(engine, statement, config, ARGS={}):
+    """
+    run one of the large ordered scans: through SQLAlchemy, or with --raw_cursor as plain tuples
+    from a raw DBAPI cursor fetching WINDOW_SIZE rows per round trip
+    """
+    if getattr(ARGS, 'raw_cursor', False):
+        with get_metrics().stage('sql.raw_execute'):
+            return stream_tuples(engine, statement, config['WINDOW_SIZE'])
+    return engine.execute(statement)
+
+
+def scan_claims(engine, config, datadict, table, where_clause, ARGS={}, top_x=''):
+    '''
+    (PID, DAY) ordered scan of `table`: the used columns (or `*`), or with --sparse_codes the narrow rows
+    merged with the non-zero binary flags of a second ordered query (see query_builder.py)
+    '''
+    statement = 'select {}{} from {} where {} order by PID, DAY'
+    if not getattr(ARGS, 'sparse_codes', False):
+        return execute_scan(engine, statement.format(top_x, select_list(datadict, ARGS), table, where_clause), config, ARGS)
+    narrow_list = ", ".join('[{}]'.format(col) for col in used_columns(datadict, binary=False))
+    dense = execute_scan(engine, statement.format(top_x, narrow_list, table, where_clause), config, ARGS)
+    flags = execute_scan(engine, sparse_flags_query(engine, datadict, table, where_clause), config, ARGS)
+    return SparseRows(dense, flags, datadict)
+
+
 def get_partial_events(engine, config, datadict, pid, ARGS={}):
     event_types = ARGS.outcome or []
     for param in (engine, config, pid):
@@ -104,24 +192,118 @@ def get_partial_events(engine, config, datadict, pid, ARGS={}):
         raise ValueError("List `event_types` must be subset of ({})".format(", ".join(acceptable_types)))
     event_clause = " and ({})".format(" or ".join(["{} = 1".format(etype) for etype in event_types])) if event_types else ''
     partials = {}
-    for row in engine.execute('select * from {} where PID = {}{}'.format(config['PARTIAL_EVENT_TABLE_NAME'], pid, event_clause)):
-        rowdict = dict(row)
-        newvisit = build_visit_dict(rowdict, datadict, set(), config)
+    results = engine.execute('select {} from {} where PID = {}{}'.format(select_list(datadict, ARGS), config['PARTIAL_EVENT_TABLE_NAME'],
+                                                                      pid, event_clause))
+    encoder = datadict.get_encoder(results.keys(), config)
+    for row in adaptive_rows(results, 'partial events (per PID)', config, ARGS):
+        newvisit = encoder.encode(row, set())
         partials[newvisit['DAY']] = newvisit
     return partials
 
-def get_all_previous_claims_days(engine, config, datadict, pid, event_day, error_cols, pid_counter, csv_writer):
+
+class PartialEventStream():
+    '''
+    One ordered pass over the partial-event table, merge-joined against the main (PID, DAY) ordered cursor.
+    `partials_for(pid)` returns the same {DAY: visit} dict as get_partial_events without a query per PID,
+    as long as PIDs are requested in the order the main cursor is sorted by
+    '''
+    def __init__(self, engine, config, datadict, ARGS={}):
+        event_clause = get_event_clause(ARGS)
+        self.results = scan_claims(engine, config, datadict, config['PARTIAL_EVENT_TABLE_NAME'], 'PID is not null and {}{}{}'
+                                   .format(get_dataset_clause(ARGS), event_clause, get_partition_clause(config, ARGS)), ARGS)
+        self.encoder = datadict.get_encoder(self.results.keys(), config)
+        self.results = prefetch_windows(self.results, config, ARGS, 'partial events')
+        self.window_size = config['WINDOW_SIZE']
+        self.batch = []
+        self.batch_pos = 0
+
+    def _current(self):
+        if self.batch_pos >= len(self.batch):
+            self.batch = self.results.fetchmany(self.window_size) if self.results is not None else []
+            self.batch_pos = 0
+            if not self.batch:
+                self.results = None
+                return None
+        return self.batch[self.batch_pos]
+
+    def partials_for(self, pid):
+        pid_idx = self.encoder.pid_idx
+        pid_key = str(pid)
+        row = self._current()
+        # skip partial-event PIDs that never show up in the main cursor
+        while row is not None and str(row[pid_idx]) != pid_key and row[pid_idx] < pid:
+            self.batch_pos += 1
+            row = self._current()
+        partials = {}
+        while row is not None and str(row[pid_idx]) == pid_key:
+            newvisit = self.encoder.encode(row, set())
+            partials[newvisit['DAY']] = newvisit
+            self.batch_pos += 1
+            row = self._current()
+        return partials
+
+def get_all_previous_claims_days(engine, config, datadict, pid, event_day, error_cols, pid_counter, csv_writer, ARGS={}):
     """
     get the full history of active claims day given a PID and final DAY in sequence
     """
-    for row in engine.execute("select * from {} where PID = '{}' and ANYCLAIM!='0' and DAY < {} order by DAY"\
-        .format(config['TABLE_NAME'], pid, event_day)):
-        rowdict = dict(row)
-        newvisit = build_visit_dict(rowdict, datadict, error_cols, config)
+    results = engine.execute("select {} from {} where PID = '{}' and ANYCLAIM!='0' and DAY < {} order by DAY"\
+        .format(select_list(datadict, ARGS), config['TABLE_NAME'], pid, event_day))
+    encoder = datadict.get_encoder(results.keys(), config)
+    for row in adaptive_rows(results, 'claims history (per PID)', config, ARGS):
+        newvisit = encoder.encode(row, error_cols)
         pid_counter.pid_rows.append(newvisit)  
     return pid_counter
 
 
+def write_instances_with_history(engine, config, datadict, instances, error_cols, pid_counter, csv_writer, ARGS={}):
+    '''
+    set-based version of calling get_all_previous_claims_days for every (PID, event day) instance:
+    the active-claims history for the dataset is streamed once (ordered by PID, DAY), each patient's rows are
+    buffered and every instance of that patient is cut as the prefix of days before its event day.
+    `instances` is a list of (pid, event_day, final_visit, target) tuples
+    assumes each PID belongs to a single PROCESS1 split; rows are written grouped by PID rather than in instance order
+    '''
+    instances_by_pid = defaultdict(list)
+    for instance in instances:
+        instances_by_pid[str(instance[0])].append(instance)
+
+    def _write_pid(pid_key, history):
+        days = [visit['DAY'] for visit in history]
+        for pid, event_day, newvisit, target in instances_by_pid.pop(pid_key):
+            pid_counter.reset_for_new_pid(pid)
+            pid_counter.prev_event_value = target
+            pid_counter.pid_rows = history[:bisect_left(days, int(event_day))]
+            pid_counter.convert_and_write(csv_writer, append=True, visit=newvisit, neg_only=False)
+
+    print("Streaming claims history for {} instances ({} patients)...".format(len(instances), len(instances_by_pid)))
+    results = scan_claims(engine, config, datadict, config['TABLE_NAME'], "ANYCLAIM!='0' and PID is not null and PROCESS1={}{}"
+                          .format(ARGS.dataset, get_partition_clause(config, ARGS)), ARGS)
+    encoder = datadict.get_encoder(results.keys(), config)
+    results = prefetch_windows(results, config, ARGS, 'claims history')
+    current_key = None
+    history = []
+    batch = results.fetchmany(config['WINDOW_SIZE'])
+    while batch:
+        for row in batch:
+            pid_key = str(row[encoder.pid_idx])
+            if pid_key != current_key:
+                if current_key in instances_by_pid:
+                    _write_pid(current_key, history)
+                current_key = pid_key
+                history = []
+            if pid_key in instances_by_pid:
+                history.append(encoder.encode(row, error_cols))
+        batch = results.fetchmany(config['WINDOW_SIZE'])
+    if current_key in instances_by_pid:
+        _write_pid(current_key, history)
+    if isinstance(results, PrefetchingCursor):
+        print(results.report('claims history'))
+    # instances whose patient has no active claims history at all
+    for pid_key in list(instances_by_pid):
+        _write_pid(pid_key, [])
+    return pid_counter
+
+
 def get_event_clause(ARGS={}):
     # determine outcome variable for model
     event_types = ARGS.outcome or []
@@ -132,16 +314,58 @@ def get_event_clause(ARGS={}):
     return " and ({})".format(" or ".join(["{} = 1".format(etype) for etype in event_types])) if event_types else ''
 
 
-def split_on_events(results, config, datadict, output, csv_writer, ARGS={}):
-    top_x = "top {} ".format(ARGS.max) if ARGS.max else ''
+def get_partition_clause(config, ARGS={}):
+    '''
+    restrict a query to this worker's share of the PID space when running with --workers
+    ARGS.partition is a (worker index, worker count) tuple; the bucket expression can be overridden
+    with config['PID_PARTITION_EXPR'] (defaults to a checksum of PID, which works for any PID column type).
+    With --delta, ARGS.pids (a list of PIDs) restricts it to those PIDs instead
+    '''
+    pids = getattr(ARGS, 'pids', None)
+    if pids is not None:
+        # --delta: the changed PIDs being re-extracted
+        return " and PID in ('{}')".format("','".join(pids))
+    partition = getattr(ARGS, 'partition', None)
+    if not partition:
+        return ''
+    worker, workers = partition
+    expr = config.get('PID_PARTITION_EXPR', 'abs(checksum(PID)) % {workers}').format(workers=workers)
+    return ' and ({}) = {}'.format(expr, worker)
+
+
+def get_dataset_clause(ARGS={}):
+    """PROCESS1 filter: the --dataset value, or all of --datasets"""
+    datasets = getattr(ARGS, 'datasets', None)
+    if datasets:
+        return 'PROCESS1 in ({})'.format(", ".join(datasets))
+    return 'PROCESS1={}'.format(ARGS.dataset)
+
+
+def split_on_events(engine, config, datadict, output, csv_writer, ARGS={}, checkpoint=None, qa=None):
+    # with a checkpoint, a resumed run continues after the last PID whose rows were committed
+    progress = checkpoint.stage('events') if checkpoint else {}
+    if progress.get('done'):
+        print("Claims already extracted up to the checkpoint ({} rows)".format(progress.get('rows_read', 0)))
+        return True
+    rows_read = progress.get('rows_read', 0)
+    max_rows = ARGS.max - rows_read if ARGS.max else None
+    top_x = "top {} ".format(max_rows) if max_rows else ''
+    resume_clause = " and PID > '{}'".format(progress['last_pid']) if progress.get('last_pid') is not None else ''
     event_clause = get_event_clause(ARGS)
-    results = engine.execute('select {}* from {} where ANYCLAIM != 0 and PID is not null and PROCESS1={} '
-                             'order by PID, DAY'.format(top_x, config['TABLE_NAME'], ARGS.dataset))
+    results = scan_claims(engine, config, datadict, config['TABLE_NAME'], 'ANYCLAIM != 0 and PID is not null and PROCESS1={}{}{}'
+                          .format(ARGS.dataset, get_partition_clause(config, ARGS), resume_clause), ARGS, top_x)
 
     error_cols = set()
+    encoder = datadict.get_encoder(results.keys(), config)
+    partial_stream = PartialEventStream(engine, config, datadict, ARGS) if ARGS.use_partials and ARGS.bulk_partials else None
+    results = prefetch_windows(results, config, ARGS, 'claims')
     batch = results.fetchmany(config['WINDOW_SIZE'])
     batch_num = 0
     pid_counter = PID_Counter(preferred_types=ARGS.outcome)
+    metrics = get_metrics()
+    # last PID whose rows have all been written, and how many claim-days the written PIDs had
+    completed_pid = None
+    pid_rows_read = 0
 
     '''
     in order to split PID's with multiple events within their span of visits,
@@ -152,17 +376,29 @@ def split_on_events(results, config, datadict, output, csv_writer, ARGS={}):
     while batch:
         batch_num += 1
         print("Processing batch #{}:".format(batch_num))
-        for row in tqdm(batch):
-            rowdict = dict(row)
-            newvisit = build_visit_dict(rowdict, datadict, error_cols, config)
+        visits = encoder.encode_batch(batch, error_cols) if ARGS.batch_encode else (encoder.encode(row, error_cols) for row in batch)
+        for newvisit in tqdm(visits, total=len(batch)):
             if pid_counter.is_new_pid(newvisit['PID']):
                 if pid_counter.pid and pid_counter.pid_rows:
                     pid_counter.convert_and_write(csv_writer)
+                if pid_counter.pid:
+                    completed_pid = pid_counter.pid
+                    rows_read += pid_rows_read
+                    pid_rows_read = 0
+                metrics.start_pid(newvisit['PID'])
                 pid_counter.reset_for_new_pid(newvisit['PID'])
-                if ARGS.use_partials:
+                if partial_stream:
+                    pid_counter.partial_events = partial_stream.partials_for(newvisit['PID'])
+                elif ARGS.use_partials:
                     pid_counter.partial_events = get_partial_events(engine, config, datadict, newvisit['PID'], ARGS)
             pid_counter.process_row(newvisit)
+            pid_rows_read += 1
+            metrics.pid_row()
+            if qa:
+                qa.add(newvisit['PID'], newvisit['DAY'], any(newvisit.get(etype) == 1 for etype in ARGS.outcome))
             
+        if checkpoint and completed_pid is not None:
+            checkpoint.maybe_commit('events', last_pid=str(completed_pid), rows_read=rows_read)
         batch = results.fetchmany(config['WINDOW_SIZE'])
         #in the case that we have hit the end of our query, we need to write
         #the remaining rows out for processing
@@ -170,111 +406,734 @@ def split_on_events(results, config, datadict, output, csv_writer, ARGS={}):
             pid_counter.convert_rows_to_wide_rep()
             pid_counter.write_all_rows(csv_writer)
 
+    if isinstance(results, PrefetchingCursor):
+        print(results.report('claims'))
+    if checkpoint:
+        checkpoint.commit('events', done=True, rows_read=rows_read + pid_rows_read)
     if error_cols:
         print("Experienced errors with the following columns: {}".format(", ".join(list(error_cols))))
     return True
 
 
-def split_on_matched_control(engine, config, datadict, negative_instances, output, csv_writer, ARGS={}):
-
+def split_on_events_multi(engine, config, datadict, writers, ARGS={}):
+    '''
+    split_on_events for several outcome sets and PROCESS1 datasets from one scan (--outcomes/--datasets):
+    each claim-day is encoded once and fed to one PID_Counter per outcome set, and each patient's rows are written
+    to the writer of its (outcome set, PROCESS1) combination. `writers` is a {("".join(outcome set), dataset): writer} dict
+    '''
     top_x = "top {} ".format(ARGS.max) if ARGS.max else ''
-    event_clause = get_event_clause(ARGS)
-    results = engine.execute('select {}* from {} where PID is not null and PROCESS1={} {}'
-                .format(top_x, config['PARTIAL_EVENT_TABLE_NAME'], ARGS.dataset, event_clause))
-    if negative_instances:
-        print ('querying negative instances from full table')
-        results = engine.execute('select {}* from {} where PID is not null and PROCESS1={} {} and ANYCLAIM=1'
-            .format(top_x, config['TABLE_NAME'], ARGS.dataset, event_clause.replace('and', 'and not')))
-
+    results = scan_claims(engine, config, datadict, config['TABLE_NAME'], 'ANYCLAIM != 0 and PID is not null and {}{}'
+                          .format(get_dataset_clause(ARGS), get_partition_clause(config, ARGS)), ARGS, top_x)
     error_cols = set()
+    keys = list(results.keys())
+    encoder = datadict.get_encoder(keys, config)
+    dataset_idx = keys.index('PROCESS1')
+    # partial event days are pulled once for the union of the outcome sets and filtered per set
+    all_types = sorted(set(etype.upper() for outcome in ARGS.outcomes for etype in outcome))
+    partial_args = copy(ARGS)
+    partial_args.outcome = all_types
+    partial_stream = PartialEventStream(engine, config, datadict, partial_args) if ARGS.use_partials and ARGS.bulk_partials else None
+    results = prefetch_windows(results, config, ARGS, 'claims')
+    pid_counters = [PID_Counter(preferred_types=outcome) for outcome in ARGS.outcomes]
+    names = ["".join(outcome) for outcome in ARGS.outcomes]
+    metrics = get_metrics()
+    pid_dataset = None
     batch = results.fetchmany(config['WINDOW_SIZE'])
     batch_num = 0
-    pid_counter = PID_Counter(preferred_types=ARGS.outcome)
-    events_by_day = defaultdict(list)
-    print("Querying Positive Event Days...")
     while batch:
         batch_num += 1
         print("Processing batch #{}:".format(batch_num))
-        for row in tqdm(batch):
-            rowdict = dict(row)
-            newvisit = build_visit_dict(rowdict, datadict, error_cols, config)
-            # if querying by matched queries, each 'row' is an outcome event from the partials table
-            event_day = rowdict['DAY']
-            pid = rowdict['PID']
-            pid_counter.reset_for_new_pid(pid)
-            if not negative_instances:
-                pid_counter.prev_event_value = 1
-            else:
-                pid_counter.prev_event_value = 0
-            # find all previous days for that positive instance from the full claims table
-            pid_counter = get_all_previous_claims_days(engine, config, datadict, pid, event_day, error_cols, pid_counter, csv_writer)
-            pid_counter.convert_and_write(csv_writer, append=True, visit=newvisit, neg_only=False)
+        visits = encoder.encode_batch(batch, error_cols) if ARGS.batch_encode else (encoder.encode(row, error_cols) for row in batch)
+        for row, newvisit in tqdm(zip(batch, visits), total=len(batch)):
+            if pid_counters[0].is_new_pid(newvisit['PID']):
+                for pid_counter, name in zip(pid_counters, names):
+                    if pid_counter.pid and pid_counter.pid_rows:
+                        pid_counter.convert_and_write(writers[(name, pid_dataset)])
+                metrics.start_pid(newvisit['PID'])
+                partials = {}
+                if partial_stream:
+                    partials = partial_stream.partials_for(newvisit['PID'])
+                elif ARGS.use_partials:
+                    partials = get_partial_events(engine, config, datadict, newvisit['PID'], partial_args)
+                for pid_counter in pid_counters:
+                    pid_counter.reset_for_new_pid(newvisit['PID'])
+                    pid_counter.partial_events = {day: visit for day, visit in partials.items()
+                                                  if any(visit.get(etype) == 1 for etype in pid_counter.preferred_event_types)}
+                pid_dataset = str(int(row[dataset_idx]))
+            for pid_counter in pid_counters:
+                pid_counter.process_row(newvisit)
+            metrics.pid_row()
+        batch = results.fetchmany(config['WINDOW_SIZE'])
+        if not batch:
+            for pid_counter, name in zip(pid_counters, names):
+                pid_counter.convert_rows_to_wide_rep()
+                pid_counter.write_all_rows(writers[(name, pid_dataset)])
+
+    if isinstance(results, PrefetchingCursor):
+        print(results.report('claims'))
+    if error_cols:
+        print("Experienced errors with the following columns: {}".format(", ".join(list(error_cols))))
+    return True
+
+
+def get_sampling_seed(ARGS={}):
+    """
+    --seed for the control sampler; each --workers bucket gets its own stream derived from it
+    """
+    seed = getattr(ARGS, 'seed', None)
+    partition = getattr(ARGS, 'partition', None)
+    if seed is not None and partition:
+        return [seed, partition[0]]
+    return seed
+
 
+def split_on_matched_control(engine, config, datadict, negative_instances, output, csv_writer, ARGS={}, checkpoint=None):
+
+    # with a checkpoint, instance rows are read in (PID, DAY) order so a resumed run can continue after the last committed one
+    stage = 'matched_negative' if negative_instances else 'matched'
+    progress = checkpoint.stage(stage + '_rows') if checkpoint else {}
+    rows_read = progress.get('rows_read', 0)
+    max_rows = ARGS.max - rows_read if ARGS.max else None
+    top_x = "top {} ".format(max_rows) if max_rows else ''
+    event_clause = get_event_clause(ARGS)
+    partition_clause = get_partition_clause(config, ARGS)
+    resume_clause = ''
+    if progress.get('last_pid') is not None:
+        resume_clause = " and (PID > '{0}' or (PID = '{0}' and DAY > {1}))".format(progress['last_pid'], progress['last_day'])
+    order_clause = ' order by PID, DAY' if checkpoint else ''
+    pid_counter = PID_Counter(preferred_types=ARGS.outcome)
+    events_by_day = defaultdict(list)
+    # with --bulk_history, instances are collected here and their histories pulled in one pass at the end
+    instances = []
+    error_cols = set()
+    if checkpoint:
+        for pid, event_day, instance in checkpoint.records(stage + '_rows'):
             events_by_day[event_day].append(pid)
+            if instance:
+                instances.append(instance)
+        instances.extend(checkpoint.records(stage + '_controls'))
+
+    if progress.get('done'):
+        print("Event days already read up to the checkpoint ({} rows)".format(rows_read))
+    else:
+        if negative_instances:
+            print ('querying negative instances from full table')
+            results = execute_scan(engine, 'select {}{} from {} where PID is not null and PROCESS1={} {} and ANYCLAIM=1{}{}{}'
+                .format(top_x, select_list(datadict, ARGS), config['TABLE_NAME'], ARGS.dataset, event_clause.replace('and', 'and not'), partition_clause,
+                        resume_clause, order_clause), config, ARGS)
+        else:
+            results = execute_scan(engine, 'select {}{} from {} where PID is not null and PROCESS1={} {}{}{}{}'
+                        .format(top_x, select_list(datadict, ARGS), config['PARTIAL_EVENT_TABLE_NAME'], ARGS.dataset, event_clause, partition_clause,
+                                resume_clause, order_clause), config, ARGS)
+
+        encoder = datadict.get_encoder(results.keys(), config)
+        results = prefetch_windows(results, config, ARGS, 'event days')
         batch = results.fetchmany(config['WINDOW_SIZE'])
+        batch_num = 0
+        print("Querying Positive Event Days...")
+        while batch:
+            batch_num += 1
+            print("Processing batch #{}:".format(batch_num))
+            visits = encoder.encode_batch(batch, error_cols) if ARGS.batch_encode else (encoder.encode(row, error_cols) for row in batch)
+            for row, newvisit in tqdm(zip(batch, visits), total=len(batch)):
+                # if querying by matched queries, each 'row' is an outcome event from the partials table
+                event_day = row[encoder.day_idx]
+                pid = row[encoder.pid_idx]
+                rows_read += 1
+                if ARGS.bulk_history:
+                    instance = (pid, event_day, newvisit, 0 if negative_instances else 1)
+                    instances.append(instance)
+                    events_by_day[event_day].append(pid)
+                    if checkpoint:
+                        checkpoint.record(stage + '_rows', (pid, event_day, instance))
+                    continue
+                pid_counter.reset_for_new_pid(pid)
+                if not negative_instances:
+                    pid_counter.prev_event_value = 1
+                else:
+                    pid_counter.prev_event_value = 0
+                # find all previous days for that positive instance from the full claims table
+                pid_counter = get_all_previous_claims_days(engine, config, datadict, pid, event_day, error_cols, pid_counter, csv_writer, ARGS)
+                pid_counter.convert_and_write(csv_writer, append=True, visit=newvisit, neg_only=False)
+
+                events_by_day[event_day].append(pid)
+                if checkpoint:
+                    checkpoint.record(stage + '_rows', (pid, event_day, None))
+            if checkpoint:
+                checkpoint.maybe_commit(stage + '_rows', last_pid=str(pid), last_day=event_day, rows_read=rows_read)
+            batch = results.fetchmany(config['WINDOW_SIZE'])
+        if isinstance(results, PrefetchingCursor):
+            print(results.report('event days'))
+        if checkpoint:
+            checkpoint.commit(stage + '_rows', done=True, rows_read=rows_read)
 
 
     print("Querying Negative Event Days...")
-    for event_day, pid_list in tqdm(events_by_day.items()):
+    progress = checkpoint.stage(stage + '_controls') if checkpoint else {}
+    sampler = None
+    if ARGS.control_index and ARGS.match_num and not progress.get('done'):
+        print("Building eligible control index...")
+        sampler = ControlSampler(engine, config, ARGS.dataset, event_clause.strip(' and'), partition_clause,
+                                 days=events_by_day, seed=get_sampling_seed(ARGS), unique=ARGS.unique_controls,
+                                 columns=select_list(datadict, ARGS), adaptive=getattr(ARGS, 'adaptive_window', False))
+        print("Indexed {} eligible control claim-days over {} event days".format(len(sampler), len(sampler.index)))
+        if progress.get('state_file'):
+            sampler.set_state(checkpoint.state(stage + '_controls'))
+    # sorted so that seeded draws (and checkpointed event days) happen in the same order on every run
+    event_days = sorted(events_by_day.items()) if sampler or checkpoint else events_by_day.items()
+    if progress.get('done'):
+        event_days = []
+    elif 'last_day' in progress:
+        event_days = [(event_day, pid_list) for event_day, pid_list in event_days if event_day > progress['last_day']]
+    for event_day, pid_list in tqdm(event_days):
         # find N (match_num) random negative instances and then all previous days from the full claims table
         total_match_num = ARGS.match_num * len(pid_list)
         match_found = 0
-        # changed by Lily. Remove PIDs who ever had positive events. 
-        for row in engine.execute("select top {} * from {} where PID not in (select PID from {} where {}) and PID not in ('{}') and ANYCLAIM!='0' and DAY = {} \
-                                and not {} and PROCESS1={} order by newid()".format(total_match_num, config['TABLE_NAME'],config['PARTIAL_EVENT_TABLE_NAME'], event_clause.strip(' and'),
-                                "','".join(pid_list), event_day, event_clause.strip(' and'), ARGS.dataset)):
+        if sampler:
+            keys, matches = sampler.fetch_rows(event_day, sampler.sample(event_day, total_match_num, exclude=pid_list))
+        else:
+            # changed by Lily. Remove PIDs who ever had positive events. 
+            matches = engine.execute("select top {} {} from {} where PID not in (select PID from {} where {}) and PID not in ('{}') and ANYCLAIM!='0' and DAY = {} \
+                                    and not {} and PROCESS1={}{} order by newid()".format(total_match_num, select_list(datadict, ARGS), config['TABLE_NAME'],config['PARTIAL_EVENT_TABLE_NAME'], event_clause.strip(' and'),
+                                    "','".join(pid_list), event_day, event_clause.strip(' and'), ARGS.dataset, partition_clause))
+            keys = matches.keys()
+            matches = adaptive_rows(matches, 'matched controls (per day)', config, ARGS)
+        match_encoder = datadict.get_encoder(keys, config) if keys else None
+        for row in matches:
             match_found += 1
-            rowdict = dict(row)
-            newvisit = build_visit_dict(rowdict, datadict, error_cols, config)
-            rand_pid = rowdict['PID']
+            newvisit = match_encoder.encode(row, error_cols)
+            rand_pid = row[match_encoder.pid_idx]
+            if ARGS.bulk_history:
+                instances.append((rand_pid, event_day, newvisit, 0))
+                if checkpoint:
+                    checkpoint.record(stage + '_controls', instances[-1])
+                continue
             pid_counter.reset_for_new_pid(rand_pid)
-            pid_counter = get_all_previous_claims_days(engine, config, datadict, rand_pid, event_day, error_cols, pid_counter, csv_writer)
+            pid_counter = get_all_previous_claims_days(engine, config, datadict, rand_pid, event_day, error_cols, pid_counter, csv_writer, ARGS)
             pid_counter.convert_and_write(csv_writer, append=True, visit=newvisit, neg_only=False)
         if match_found != total_match_num:
-            print('Warning: missing ' + str(total_match_num-match_found) + ' matches for instance ' + pid)
+            print('Warning: missing ' + str(total_match_num-match_found) + ' matches for event day ' + str(event_day))
+        if checkpoint:
+            checkpoint.maybe_commit(stage + '_controls', sampler.get_state() if sampler else None, last_day=event_day)
+    if checkpoint and not progress.get('done'):
+        checkpoint.commit(stage + '_controls', sampler.get_state() if sampler else None, done=True)
+    if instances and not (checkpoint and checkpoint.stage(stage + '_history').get('done')):
+        write_instances_with_history(engine, config, datadict, instances, error_cols, pid_counter, csv_writer, ARGS)
+        if checkpoint:
+            checkpoint.commit(stage + '_history', done=True)
     if error_cols:
         print("Experienced errors with the following columns: {}".format(", ".join(list(error_cols))))
     return True
 
 
+def get_checkpoint_dir(config, ARGS={}):
+    '''
+    checkpoint directory of a run under config['CHECKPOINT_DIR'] (defaults to ./checkpoints), keyed by every
+    argument that changes the output plus the dictionary files; each --workers bucket gets its own subdirectory
+    '''
+    run_args = [config['TABLE_NAME'], config['PARTIAL_EVENT_TABLE_NAME'], dictionary_hash()]
+    run_args += ["{}={}".format(name, getattr(ARGS, name, None)) for name in
+                 ('dataset', 'outcome', 'max', 'use_partials', 'match_num', 'day_instance', 'control_index',
+                  'unique_controls', 'seed', 'workers')]
+    key = hashlib.sha1("|".join(run_args).encode('utf-8')).hexdigest()
+    run_dir = os.path.join(config.get('CHECKPOINT_DIR', './checkpoints'), "_".join(["".join(ARGS.outcome), ARGS.dataset, key[:12]]))
+    partition = getattr(ARGS, 'partition', None)
+    if partition:
+        return os.path.join(run_dir, 'partition_{}_of_{}'.format(*partition)), key
+    return run_dir, key
+
+
+def run_splits(engine, config, datadict, output, csv_writer, ARGS={}):
+    """
+    run the split matching the dataset type (events, or matched control / day instances), writing rows to csv_writer
+    with --checkpoint/--resume, rows are committed to the run's checkpoint as they are produced and replayed into csv_writer at the end
+    """
+    checkpoint = None
+    qa = None
+    csv_writer = get_metrics().timed_writer(csv_writer, 'write')
+    if getattr(ARGS, 'qa', False):
+        # inline QA: expected instances counted from the streamed claims, actual ones from the rows written
+        qa = ExpectedEvents()
+        csv_writer = CountingWriter(csv_writer)
+    writer = csv_writer
+    if getattr(ARGS, 'checkpoint', False):
+        checkpoint_dir, run_key = get_checkpoint_dir(config, ARGS)
+        checkpoint = Checkpoint(checkpoint_dir, run_key, ARGS.resume, ARGS.checkpoint_rows)
+        writer = checkpoint
+    if ARGS.match_num or ARGS.day_instance:
+        split_on_matched_control(engine, config, datadict, False, output, writer, ARGS, checkpoint)
+        if ARGS.day_instance:
+            split_on_matched_control(engine, config, datadict, True, output, writer, ARGS, checkpoint)
+    else:
+        split_on_events(engine, config, datadict, output, writer, ARGS, checkpoint, qa)
+    if checkpoint:
+        with get_metrics().stage('checkpoint.replay'):
+            print("Replaying {} checkpointed rows...".format(checkpoint.replay(csv_writer)))
+    if qa:
+        qa.finish()
+        if not (ARGS.match_num or ARGS.day_instance):
+            print("QA: expected {} instances (outcome days + final claim day) for {} patients".format(qa.instances, qa.patients))
+        print("QA: wrote {} instances ({} positive) for {} patients".format(csv_writer.rows, csv_writer.positives, len(csv_writer.patients)))
+
+
+def get_output_files(config, ARGS={}):
+    """final output file names are variable based on dataset and outcome variable"""
+    data_file = "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset, 'data.pkl'])
+    target_file = "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset,'target.pkl'])
+    return data_file, target_file
+
+
+def get_batch_index_file(data_file):
+    """the batch index saved next to a data file (..._data.pkl -> ..._batches.pkl, shards keep their number)"""
+    return '_batches'.join(data_file.rsplit('_data', 1))
+
+
+def stream_to_shards(engine, config, datadict, ARGS={}):
+    """
+    Queries data from HICOR db and streams finished patient rows to sorted on-disk shards instead of building a DF.
+    """
+    print("Pulling {} entries from DB (streaming to shards of {} rows)...".format(
+        'first {}'.format(ARGS.max) if ARGS.max else 'all', ARGS.shard_size))
+    writer = ShardedWriter(config['HEADERS'], ARGS.shard_dir, ARGS.shard_size)
+    # feature statistics are accumulated as the rows stream past
+    stats = get_feature_stats(datadict, config, ARGS, writer)
+    run_splits(engine, config, datadict, None, writer if stats is None else stats, ARGS)
+    print("Merging {} rows from {} sorted runs...".format(len(writer), len(writer.run_files) + (1 if writer.buffer else 0)))
+    data_file, target_file = get_output_files(config, ARGS)
+    with get_metrics().stage('output.finalize', rows=len(writer)):
+        written = writer.finalize(data_file, target_file, ARGS.merge_shards)
+    if stats is not None and finish_feature_stats(stats, data_file, ARGS):
+        with get_metrics().stage('output.transform', rows=len(writer)):
+            for shard_data_file, _ in written:
+                df = pd.read_pickle(shard_data_file)
+                transform_features(df, stats)
+                df.to_pickle(shard_data_file)
+    if ARGS.batch_tokens:
+        # one index per shard, over the shard's own rows
+        with get_metrics().stage('output.batch_index', rows=len(writer)):
+            for shard_data_file, _ in written:
+                write_batch_index(pd.read_pickle(shard_data_file)['visit_num'].values, get_batch_index_file(shard_data_file),
+                                  ARGS.batch_tokens, ARGS.seed)
+    return written
+
+
+def get_watermark_file(config, ARGS={}):
+    return "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset, 'watermark.pkl'])
+
+
+def get_shard_files(data_file, target_file):
+    """the (data, target) shard pairs --stream_output wrote for these output files, in shard order"""
+    data_shards = sorted(glob.glob(glob.escape(os.path.splitext(data_file)[0]) + '_[0-9][0-9][0-9][0-9][0-9].pkl'))
+    return [(data_shard, os.path.splitext(target_file)[0] + data_shard[-10:]) for data_shard in data_shards]
+
+
+def extract_delta(engine, config, datadict, ARGS={}):
+    '''
+    --delta: re-extract only the PIDs whose watermark (see watermark.py) changed since the last run and patch
+    their rows into the existing data/target files (or --stream_output shards). Without a watermark for this
+    run (first run, or the output-changing arguments changed), everything is extracted and the watermark recorded.
+    returns the list of (data file, target file) pairs written
+    '''
+    data_file, target_file = get_output_files(config, ARGS)
+    sharded = ARGS.stream_output and not ARGS.merge_shards
+    output_files = get_shard_files(data_file, target_file) if sharded else [(data_file, target_file)]
+    watermark_file = get_watermark_file(config, ARGS)
+    run_key = get_checkpoint_dir(config, ARGS)[1]
+    # read before extracting: rows landing during the run show up as changes next time
+    with get_metrics().stage('delta.watermarks'):
+        current = read_watermarks(engine, config, get_dataset_clause(ARGS), ARGS.use_partials)
+    previous = load_watermarks(watermark_file, run_key)
+    if previous is None or not output_files or not all(os.path.exists(path) for pair in output_files for path in pair):
+        print("No watermark or output for this run yet, extracting all {} patients...".format(len(current)))
+        if ARGS.stream_output:
+            written = stream_to_shards(engine, config, datadict, ARGS)
+        else:
+            df = load_into_df(engine, config, datadict, ARGS)
+            save_output_files(df, data_file, target_file, ARGS, collect_feature_stats(df, datadict, config, data_file, ARGS))
+            written = [(data_file, target_file)]
+        save_watermarks(watermark_file, run_key, current)
+        return written
+
+    changed, removed = changed_pids(previous, current)
+    print("Delta: {} new or changed and {} removed patients (of {})".format(len(changed), len(removed), len(current)))
+    writer = ColumnarWriter(config['HEADERS'])
+    pids = sorted(changed)
+    for start in range(0, len(pids), DELTA_PID_CHUNK):
+        chunk_args = copy(ARGS)
+        chunk_args.pids = pids[start:start + DELTA_PID_CHUNK]
+        run_splits(engine, config, datadict, None, writer, chunk_args)
+    new_df = writer.to_dataframe()
+    # every output row of a changed or removed PID is replaced
+    stale = changed.union(removed)
+    known = set(current).union(previous)
+    kept = 0
+    with get_metrics().stage('delta.patch', rows=len(new_df)):
+        if sharded:
+            shard_writer = ShardedWriter(config['HEADERS'], ARGS.shard_dir, ARGS.shard_size)
+            stats = get_feature_stats(datadict, config, ARGS, shard_writer)
+            shard_writer = shard_writer if stats is None else stats
+            for shard_data_file, shard_target_file in output_files:
+                df = pd.read_pickle(shard_data_file)
+                df['target'] = pd.read_pickle(shard_target_file)['target']
+                for row in df[config['HEADERS']].to_dict('records'):
+                    if source_pid(str(row['PID']), known) not in stale:
+                        shard_writer.writerow(row)
+                        kept += 1
+            shard_writer.writerows(new_df.to_dict('records'))
+            if stats is not None:
+                shard_writer = stats.writer
+                finish_feature_stats(stats, data_file, ARGS)
+            written = shard_writer.finalize(data_file, target_file)
+            # the patched output may need fewer shards than before
+            for shard_data_file, shard_target_file in output_files[len(written):]:
+                for path in (shard_data_file, shard_target_file, get_batch_index_file(shard_data_file)):
+                    if os.path.exists(path):
+                        os.remove(path)
+        else:
+            df = pd.read_pickle(data_file).drop(columns='visit_num')
+            df['target'] = pd.read_pickle(target_file)['target']
+            df = df[[source_pid(str(pid), known) not in stale for pid in df['PID']]]
+            kept = len(df)
+            df = pd.concat([df[config['HEADERS']], new_df], ignore_index=True)
+            save_output_files(df, data_file, target_file, stats=collect_feature_stats(df, datadict, config, data_file, ARGS))
+            written = [(data_file, target_file)]
+    if ARGS.batch_tokens:
+        with get_metrics().stage('output.batch_index'):
+            for shard_data_file, _ in written:
+                write_batch_index(pd.read_pickle(shard_data_file)['visit_num'].values, get_batch_index_file(shard_data_file),
+                                  ARGS.batch_tokens, ARGS.seed)
+    print("Patched output: {} rows kept, {} rows rebuilt".format(kept, len(new_df)))
+    save_watermarks(watermark_file, run_key, current)
+    return written
+
+
+def write_packed(engine, config, datadict, ARGS={}):
+    """
+    Queries data from HICOR db and packs patient rows into flat CSR-style arrays (see packed_format.py).
+    """
+    print("Pulling {} entries from DB (packed output)...".format('first {}'.format(ARGS.max) if ARGS.max else 'all'))
+    writer = PackedWriter(len(datadict.numeric_cols))
+    run_splits(engine, config, datadict, None, writer, ARGS)
+    print("Saving {} packed patient rows...".format(len(writer)))
+    data_file, target_file = get_output_files(config, ARGS)
+    with get_metrics().stage('output.finalize', rows=len(writer)):
+        return writer.save(data_file.replace('_data.pkl', '_packed'))
+
+
+def write_prefix_indexed(engine, config, datadict, ARGS={}):
+    """
+    Queries data from HICOR db and stores each patient's visit sequence once, with every output row as a
+    (sequence, cut, extra visit, target) instance over it (see PrefixWriter in packed_format.py).
+    """
+    print("Pulling {} entries from DB (prefix-indexed output)...".format('first {}'.format(ARGS.max) if ARGS.max else 'all'))
+    writer = PrefixWriter(len(datadict.numeric_cols))
+    run_splits(engine, config, datadict, None, writer, ARGS)
+    print("Saving {} instances over {} visit sequences...".format(len(writer), len(writer.sequence_starts) + (1 if writer.group else 0)))
+    data_file, target_file = get_output_files(config, ARGS)
+    with get_metrics().stage('output.finalize', rows=len(writer)):
+        return writer.save(data_file.replace('_data.pkl', '_prefix'))
+
+
+def extract_multi(engine, config, datadict, ARGS={}):
+    """
+    Builds the data/target files of every --outcomes x --datasets combination from a single scan (see split_on_events_multi).
+    """
+    print("Pulling {} entries from DB for outcomes {} and datasets {}...".format(
+        'first {}'.format(ARGS.max) if ARGS.max else 'all', ", ".join("".join(outcome) for outcome in ARGS.outcomes),
+        ", ".join(ARGS.datasets)))
+    combinations = [(outcome, dataset) for outcome in ARGS.outcomes for dataset in ARGS.datasets]
+    writers = {("".join(outcome), dataset): get_metrics().timed_writer(ColumnarWriter(config['HEADERS']), 'write')
+               for outcome, dataset in combinations}
+    split_on_events_multi(engine, config, datadict, writers, ARGS)
+    output_files = []
+    for outcome, dataset in combinations:
+        combination_args = copy(ARGS)
+        combination_args.outcome = outcome
+        combination_args.dataset = dataset
+        writer = writers[("".join(outcome), dataset)]
+        print("Building dataframe from {} rows ({} outcome, dataset {})...".format(len(writer), "".join(outcome), dataset))
+        with get_metrics().stage('dataframe', rows=len(writer)):
+            df = writer.to_dataframe()
+        data_file, target_file = get_output_files(config, combination_args)
+        save_output_files(df, data_file, target_file, ARGS, collect_feature_stats(df, datadict, config, data_file, ARGS))
+        output_files.append((data_file, target_file))
+    return output_files
+
+
+def get_feature_stats(datadict, config, ARGS={}, writer=None):
+    """a FeatureStats accumulator (passing rows on to `writer`) when --feature_stats/--normalize/--min_code_count is set, else None"""
+    if not getattr(ARGS, 'feature_stats', False):
+        return None
+    code_names = {code_id: code for code, code_id in datadict.code_mappings.items()}
+    return FeatureStats(datadict.numeric_cols, code_names, config.get('NUMERIC_SENTINELS', DEFAULT_SENTINELS), writer)
+
+
+def finish_feature_stats(stats, data_file, ARGS={}):
+    '''
+    write the feature statistics report of an output (and its compacted dictionary with --min_code_count)
+    returns whether the rows need transforming (--normalize/--min_code_count)
+    '''
+    code_map = stats.prepare(ARGS.normalize, ARGS.min_code_count)
+    stats_file = '_feature_stats.json'.join(data_file.rsplit('_data.pkl', 1))
+    stats.write(stats_file, code_map)
+    print("Feature statistics created: {} ({} rows, {} visits, {} distinct codes)".format(
+        stats_file, stats.rows, stats.visits, len(stats.code_counts)))
+    if code_map is not None:
+        dictionary_file = '_dictionary.pkl'.join(data_file.rsplit('_data.pkl', 1))
+        with open(dictionary_file, 'wb') as fout:
+            pickle.dump(stats.compacted_dictionary(code_map), fout)
+        print("Compacted dictionary created: {} ({} of {} codes seen in at least {} visits, plus {})".format(
+            dictionary_file, len(code_map), len(stats.code_counts), ARGS.min_code_count, RARE_CODE))
+    return bool(ARGS.normalize or code_map is not None)
+
+
+def collect_feature_stats(df, datadict, config, data_file, ARGS={}):
+    """feature statistics of an in-memory output, in one pass over its rows (None without --feature_stats)"""
+    stats = get_feature_stats(datadict, config, ARGS)
+    if stats is None:
+        return None
+    with get_metrics().stage('output.feature_stats', rows=len(df)):
+        for numerics, codes in zip(df['numerics'], df['codes']):
+            stats.writerow({'numerics': numerics, 'codes': codes})
+        finish_feature_stats(stats, data_file, ARGS)
+    return stats
+
+
+def transform_features(df, stats):
+    """normalize numerics / remap codes of the data frame in place, as set up by `stats.prepare`"""
+    transformed = [stats.transform(numerics, codes) for numerics, codes in zip(df['numerics'], df['codes'])]
+    df['numerics'] = pd.Series([numerics for numerics, _ in transformed], index=df.index, dtype=object)
+    df['codes'] = pd.Series([codes for _, codes in transformed], index=df.index, dtype=object)
+
+
+def save_output_files(df, data_file, target_file, ARGS={}, stats=None):
+    # sort by patients with the most "visits" first
+    # len of codes and numerics should be the same (one list of features per "visit")
+    df['visit_num'] = df['codes'].str.len()
+    df = df.sort_values('visit_num', ascending=False)
+    if stats is not None and (stats.normalize_numerics or stats.codes is not None):
+        with get_metrics().stage('output.transform', rows=len(df)):
+            transform_features(df, stats)
+    # keep the outcome variable as for the target file and lose the rest
+    target_df = pd.DataFrame(df.pop('target'))
+    with get_metrics().stage('output.pickle', rows=len(df)):
+        df.to_pickle(data_file)
+        target_df.to_pickle(target_file)
+    if getattr(ARGS, 'batch_tokens', 0):
+        with get_metrics().stage('output.batch_index', rows=len(df)):
+            write_batch_index(df['visit_num'].values, get_batch_index_file(data_file), ARGS.batch_tokens, ARGS.seed)
+
+
+def extract_partition(engine_factory, config, ARGS, partition):
+    """
+    worker entry point for --workers: its own engine, DataDictionary and PID_Counter pipeline over one PID bucket
+    returns (dataframe, the worker's metrics report or None)
+    """
+    worker_args = copy(ARGS)
+    worker_args.partition = partition
+    worker_args.workers = 1
+    engine = engine_factory()
+    # a forked worker inherits the parent's collector and wrapped methods; drop them and collect its own
+    stop_metrics()
+    reset_windows()
+    if getattr(ARGS, 'no_metrics', True):
+        return load_into_df(engine, config, DataDictionary(), worker_args), None
+    metrics = start_run_metrics(engine, worker_args)
+    try:
+        df = load_into_df(engine, config, DataDictionary(), worker_args)
+        if ARGS.adaptive_window:
+            metrics.info['fetch_windows'] = window_report()
+        return df, metrics.to_dict()
+    finally:
+        stop_metrics()
+
+
+def load_into_df_parallel(engine_factory, config, ARGS={}):
+    """
+    Runs load_into_df over ARGS.workers disjoint PID buckets in separate processes and concatenates the results.
+    Partial outputs are merged in bucket order (bucket 0 first, each in its own extraction order), so the result
+    has the same rows as a serial run and is deterministic for a given worker count; --max applies per worker
+    """
+    print("Extracting with {} workers...".format(ARGS.workers))
+    partitions = [(worker, ARGS.workers) for worker in range(ARGS.workers)]
+    with Pool(ARGS.workers) as pool:
+        results = pool.starmap(extract_partition, [(engine_factory, config, ARGS, partition) for partition in partitions])
+    for _, report in results:
+        if report is not None:
+            get_metrics().merge(report)
+    return pd.concat([frame for frame, _ in results], ignore_index=True)
+
+
 def load_into_df(engine, config, datadict, ARGS={}):
     """
     Queries data from HICOR db, sorts/compiles into patient rows (split on events), and loads into DF.
     """
     print("Pulling {} entries from DB...".format('first {}'.format(ARGS.max) if ARGS.max else 'all'))
-    output = StringIO()
-    csv_writer = csv.DictWriter(output, fieldnames=config['HEADERS'], extrasaction='ignore')
-
-    if ARGS.match_num or ARGS.day_instance:
-        split_on_matched_control(engine, config, datadict, False, output, csv_writer, ARGS)
-        if ARGS.day_instance:
-            split_on_matched_control(engine, config, datadict, True, output, csv_writer, ARGS)
+    if ARGS.writer == 'csv':
+        output = StringIO()
+        csv_writer = csv.DictWriter(output, fieldnames=config['HEADERS'], extrasaction='ignore')
     else:
-        split_on_events(engine, config, datadict, output, csv_writer, ARGS)
+        # rows go straight into typed columns; no csv text or ast.literal_eval round trip
+        output = None
+        csv_writer = ColumnarWriter(config['HEADERS'])
+
+    run_splits(engine, config, datadict, output, csv_writer, ARGS)
 
+    if ARGS.writer != 'csv':
+        print("Building dataframe from {} rows...".format(len(csv_writer)))
+        with get_metrics().stage('dataframe', rows=len(csv_writer)):
+            return csv_writer.to_dataframe()
     output.seek(0)
     print("Loading into dataframe (this may take some time)...")
-    return pd.read_csv(output, header=None, names=config['HEADERS'], converters=CONVERTERS)
+    with get_metrics().stage('dataframe.read_csv'):
+        return pd.read_csv(output, header=None, names=config['HEADERS'], converters=CONVERTERS)
 
 
-def parse_arguments(parser):
+def start_run_metrics(engine, ARGS={}):
+    '''
+    start collecting stage timings for this process (see run_metrics.py): encoding and PID_Counter stages are timed
+    by wrapping their methods, SQL queries through the engine's cursor events
+    '''
+    metrics = start_metrics()
+    metrics.instrument(VisitEncoder, 'encode', 'encode', rows=lambda args: 1)
+    metrics.instrument(VisitEncoder, 'encode_batch', 'encode', rows=lambda args: len(args[1]))
+    metrics.instrument(PID_Counter, '_dupe_events', 'pid_counter.dupe_events')
+    metrics.instrument(PID_Counter, 'convert_rows_to_wide_rep', 'pid_counter.wide_rep')
+    metrics.instrument(PID_Counter, 'write_all_rows', 'pid_counter.write')
+    if engine is not None:
+        metrics.watch_engine(engine)
+    metrics.info['args'] = vars(ARGS)
+    return metrics
+
+
+def get_metrics_file(config, ARGS={}):
+    """--metrics_file, or a JSON file next to the outputs named like them"""
+    if ARGS.metrics_file:
+        return ARGS.metrics_file
+    if config.get('OUTPUT_FILEPATH'):
+        return "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset, 'metrics.json'])
+    return './metrics.json'
+
+
+def print_profile(profiler, profile_file, top=25):
+    profiler.dump_stats(profile_file)
+    print("cProfile stats written to {} (top {} by cumulative time):".format(profile_file, top))
+    pstats.Stats(profile_file).sort_stats('cumulative').print_stats(top)
+
+
+def parse_arguments(parser, argv=None):
     """parameters for the dataset (train,dev, test) to prepare, as well as the appropriate outcome variable"""
     parser.add_argument('--dataset', type=str, default='2',
                         help='dataset to prepare (1=train, 2=dev/validate, 3=test)')
     parser.add_argument('--outcome', type=str, default=None,
                         help='outcome variable in question (\'ed\' or \'ip\', defaults to both)')
+    parser.add_argument('--outcomes', type=str, nargs='+', default=None,
+                        help="build several outcome sets ('ed', 'ip', 'edip') from one scan, writing one data/target pair per outcome set and dataset")
+    parser.add_argument('--datasets', type=str, nargs='+', default=None,
+                        help="with --outcomes (or alone), the PROCESS1 datasets to build from the same scan")
     parser.add_argument('--max', type=int, default=None,
                         help="max number of visits to query from main DB")
     parser.add_argument('--trusted', action='store_true',
                         help="use trusted mssql connection (requires proper sql server drivers)")
     parser.add_argument('--use_partials', action='store_true',
                         help="query and include partial days on event-final claimdays")
+    parser.add_argument('--bulk_partials', action='store_true',
+                        help="with --use_partials, stream the partial event table once (ordered by PID, DAY) instead of querying it per PID")
     parser.add_argument('--match_num', type=int, default=0,
                         help="query data set by finding positive instances and matching with 'N' negative instances")
+    parser.add_argument('--bulk_history', action='store_true',
+                        help="with --match_num/--day_instance, pull claims histories in one ordered pass instead of one query per instance")
+    parser.add_argument('--control_index', action='store_true',
+                        help="with --match_num, draw matched controls from an in-memory day -> eligible PID index instead of one 'order by newid()' query per event day")
+    parser.add_argument('--unique_controls', action='store_true',
+                        help="with --control_index, use each PID as a matched control at most once across all event days")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="random seed for --control_index sampling (and newid() on local snapshot engines), for reproducible datasets")
     parser.add_argument('--day_instance', action='store_true',
                         help="flag to indicate making a new instance for each new day (instead of each new positive outcome event)")
-    args = parser.parse_args()
+    parser.add_argument('--writer', type=str, default='columnar', choices=['columnar', 'csv'],
+                        help="build the dataframe from typed columns directly, or through the legacy in-memory csv")
+    parser.add_argument('--stream_output', action='store_true',
+                        help="stream finished patient rows to sorted on-disk shards instead of building the full dataframe in memory")
+    parser.add_argument('--shard_size', type=int, default=100000,
+                        help="rows per spilled run / output shard with --stream_output")
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help="directory for intermediate sorted runs with --stream_output (defaults to a temp dir)")
+    parser.add_argument('--merge_shards', action='store_true',
+                        help="with --stream_output, merge into the single usual data/target files instead of numbered shards")
+    parser.add_argument('--packed_output', action='store_true',
+                        help="write flat memory-mappable numpy arrays (codes/numerics/days + offsets) instead of pickled dataframes")
+    parser.add_argument('--prefix_output', action='store_true',
+                        help="like --packed_output, but store each patient's visit sequence once and output rows as (sequence, cut, extra visit) instances over it (for --day_instance / multi-event patients)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes to split the PID space across (in-memory dataframe output only)")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="fetch up to N windows ahead on a background thread while the current one is encoded (0 = off)")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="read from local snapshots of the claims tables (built from the server on first use)")
+    parser.add_argument('--refresh_snapshot', action='store_true',
+                        help="with --snapshot, rebuild the local snapshots from the server")
+    parser.add_argument('--offline', action='store_true',
+                        help="only use existing local snapshots; never connect to the server")
+    parser.add_argument('--qa', action='store_true',
+                        help="print expected vs written instance and patient counters at the end of the run (see data_qa_checks.py; with --resume, expected counts cover the resumed part only)")
+    parser.add_argument('--checkpoint', action='store_true',
+                        help="commit finished rows and progress (last PID / event day) to a checkpoint directory as the run goes")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue from the last checkpoint of the same run (implies --checkpoint)")
+    parser.add_argument('--checkpoint_rows', type=int, default=50000,
+                        help="commit the checkpoint once this many rows are pending (at the next PID / event day boundary)")
+    parser.add_argument('--batch_encode', action='store_true',
+                        help="encode each fetched window column-wise with numpy/pandas instead of row by row")
+    parser.add_argument('--raw_cursor', action='store_true',
+                        help="run the large ordered scans on a raw DBAPI cursor (plain tuples, WINDOW_SIZE rows per round trip) instead of through SQLAlchemy")
+    parser.add_argument('--project', action='store_true',
+                        help="select only the columns the data dictionary uses instead of select *")
+    parser.add_argument('--sparse_codes', action='store_true',
+                        help="with the ordered claims scans, fetch Binary code columns as (PID, DAY, column) rows of the non-zero flags only (implies --project)")
+    parser.add_argument('--batch_tokens', type=int, default=0,
+                        help="also write a batch index next to the data/target files: instances grouped into visit count buckets, shuffled with --seed and cut into batches of at most N padded visits (0 = off)")
+    parser.add_argument('--delta', action='store_true',
+                        help="only re-extract patients whose claims changed since the watermark saved with the last --delta run, and patch them into the existing output")
+    parser.add_argument('--feature_stats', action='store_true',
+                        help="write per-numeric (count, NULLs, sentinels, mean, std, min, max) and per-code (visit count) statistics of the output rows next to the data/target files")
+    parser.add_argument('--normalize', action='store_true',
+                        help="write numerics z-scored as float32 arrays (sentinels and NULLs become 0.0) from the statistics of the same run (implies --feature_stats)")
+    parser.add_argument('--min_code_count', type=int, default=0,
+                        help="remap codes seen in at least N visits to compact ids and the rest to one shared rare id, writing the compacted dictionary (implies --feature_stats; 0 = off)")
+    parser.add_argument('--adaptive_window', action='store_true',
+                        help="size each query kind's fetchmany windows from measured rows/sec, bytes per row and RSS within config['ADAPTIVE_WINDOW'] bounds, instead of a fixed WINDOW_SIZE")
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help="where to write the JSON run report of stage timings, queries, peak RSS and slowest PIDs (defaults to next to the output files)")
+    parser.add_argument('--no_metrics', action='store_true',
+                        help="don't collect stage timings or write the run report")
+    parser.add_argument('--profile', type=str, default=None,
+                        help="run under cProfile and write the stats to this file (also prints the top functions by cumulative time)")
+    args = parser.parse_args(argv)
+    if args.workers > 1 and (args.stream_output or args.packed_output or args.prefix_output):
+        parser.error("--workers is only supported with the default in-memory dataframe output")
+    if args.batch_tokens and (args.packed_output or args.prefix_output):
+        parser.error("--batch_tokens indexes the pickled data files; it isn't supported with --packed_output/--prefix_output")
+    if args.delta and (args.max or args.match_num or args.day_instance or args.packed_output or args.prefix_output
+                       or args.workers > 1 or args.checkpoint or args.resume or args.outcomes or args.datasets):
+        parser.error("--delta only supports split_on_events over the whole table, with the in-memory or --stream_output data/target files")
+    args.feature_stats = args.feature_stats or args.normalize or args.min_code_count > 0
+    if args.feature_stats and (args.packed_output or args.prefix_output):
+        parser.error("--feature_stats/--normalize/--min_code_count work on the pickled data files; they aren't supported with --packed_output/--prefix_output")
+    if args.delta and (args.normalize or args.min_code_count):
+        parser.error("--delta patches raw rows into the existing output; it can't be combined with --normalize/--min_code_count")
     args.outcome = [args.outcome] if args.outcome else ["ED", "IP"]
+    if args.outcomes or args.datasets:
+        if (args.match_num or args.day_instance or args.stream_output or args.packed_output or args.prefix_output
+                or args.workers > 1 or args.checkpoint or args.resume or args.qa):
+            parser.error("--outcomes/--datasets only support split_on_events with the default in-memory dataframe output")
+        args.outcomes = [["ED", "IP"] if outcome.upper() == 'EDIP' else [outcome] for outcome in (args.outcomes or ["".join(args.outcome)])]
+        if not all(etype.upper() in ("ED", "IP") for outcome in args.outcomes for etype in outcome):
+            parser.error("--outcomes must be 'ed', 'ip' or 'edip'")
+        args.datasets = args.datasets or [args.dataset]
+        if (args.snapshot or args.offline) and len(args.datasets) > 1:
+            parser.error("local snapshots hold a single dataset; use one --datasets value with --snapshot/--offline")
+    args.checkpoint = args.checkpoint or args.resume
 
     return args
 
@@ -292,30 +1151,82 @@ if __name__ == '__main__':
     print("Processed Data Dictionary and Code Mapping files.")
     print("Total numerics: {}".format(len(ddict.numeric_cols)))
 
-    engine = make_engine()
+    engine = None if ARGS.offline else make_engine()
+    engine_factory = make_engine
+    if ARGS.snapshot or ARGS.offline:
+        # read from local snapshots of the claims tables instead of the live server
+        datadict_types = {col: codekey[1] for col, codekey in ddict.code_cols.items()}
+        datadict_types.update({col: 'Num' for col in ddict.numeric_cols})
+        snapshot_paths = ensure_snapshots(engine, config, ARGS.dataset, datadict_types, ARGS.offline, ARGS.refresh_snapshot)
+        engine = connect_snapshots(snapshot_paths, ARGS.seed)
+        engine_factory = partial(connect_snapshots, snapshot_paths, ARGS.seed)
 
-    df = load_into_df(engine, config, ddict, ARGS)
-    print("Process complete. DF size: {}".format(df.shape))
-    
-    # final output file name is variable based on dataset and outcome variable
-    if config.get('OUTPUT_FILEPATH'):
-        print(config['OUTPUT_FILEPATH'])
-        print(ARGS)
-        target_file = "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset,'target.pkl'])
-        data_file = "_".join([config['OUTPUT_FILEPATH'], "".join(ARGS.outcome), ARGS.dataset, 'data.pkl'])
-        
-        # sort by patients with the most "visits" first
-        # len of codes and numerics should be the same (one list of features per "visit")
-        df['visit_num'] = df['codes'].str.len()
-        df = df.sort_values('visit_num', ascending=False)
-        # keep the outcome variable as for the target file and lose the rest
-        target_df = pd.DataFrame(df.pop('target'))
-        df.to_pickle(data_file)
-        target_df.to_pickle(target_file)
-        print("DF data file created: {}".format(data_file))
-        print("DF target file created: {}".format(target_file))
-    else:
+    metrics = None if ARGS.no_metrics else start_run_metrics(engine, ARGS)
+    profiler = None
+    if ARGS.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if (ARGS.stream_output or ARGS.packed_output or ARGS.prefix_output or ARGS.outcomes or ARGS.delta) and not config.get('OUTPUT_FILEPATH'):
         print ('No output file path provided')
+    elif ARGS.delta:
+        for data_file, target_file in extract_delta(engine, config, ddict, ARGS):
+            print("DF data file created: {}".format(data_file))
+            print("DF target file created: {}".format(target_file))
+    elif ARGS.outcomes:
+        # one scan for every outcome x dataset combination
+        for data_file, target_file in extract_multi(engine, config, ddict, ARGS):
+            print("DF data file created: {}".format(data_file))
+            print("DF target file created: {}".format(target_file))
+    elif ARGS.prefix_output:
+        prefix_dir = write_prefix_indexed(engine, config, ddict, ARGS)
+        print("Prefix-indexed dataset created: {}".format(prefix_dir))
+    elif ARGS.packed_output:
+        packed_dir = write_packed(engine, config, ddict, ARGS)
+        print("Packed dataset created: {}".format(packed_dir))
+    elif ARGS.stream_output:
+        # bounded memory: rows are spilled to sorted runs as they are produced and merged at the end
+        for data_file, target_file in stream_to_shards(engine, config, ddict, ARGS):
+            print("DF data file created: {}".format(data_file))
+            print("DF target file created: {}".format(target_file))
+    else:
+        if ARGS.workers > 1:
+            df = load_into_df_parallel(engine_factory, config, ARGS)
+        else:
+            df = load_into_df(engine, config, ddict, ARGS)
+        print("Process complete. DF size: {}".format(df.shape))
+        
+        # final output file name is variable based on dataset and outcome variable
+        if config.get('OUTPUT_FILEPATH'):
+            print(config['OUTPUT_FILEPATH'])
+            print(ARGS)
+            data_file, target_file = get_output_files(config, ARGS)
+            save_output_files(df, data_file, target_file, ARGS, collect_feature_stats(df, ddict, config, data_file, ARGS))
+            print("DF data file created: {}".format(data_file))
+            print("DF target file created: {}".format(target_file))
+        else:
+            print ('No output file path provided')
+
+    if ARGS.checkpoint and config.get('OUTPUT_FILEPATH'):
+        # the output files are complete, so the run's checkpoint is no longer needed
+        Checkpoint.remove(get_checkpoint_dir(config, ARGS)[0])
+
+    if ARGS.adaptive_window:
+        windows = window_report()
+        for name, window in windows.items():
+            print("Fetch window ({}): {} -> {} rows (min {}, max {}) over {} windows".format(
+                name, window['initial'], window['final'], window['min'], window['max'], window['windows']))
+        if metrics:
+            metrics.info['fetch_windows'] = windows
+
+    if profiler:
+        profiler.disable()
+        print_profile(profiler, ARGS.profile)
+    if metrics:
+        metrics_file = get_metrics_file(config, ARGS)
+        report = metrics.write(metrics_file)
+        stop_metrics()
+        print("Run report written to {} ({} queries, peak RSS {} MB)".format(metrics_file, report['sql']['queries'], report['peak_rss_mb']))
 
     print ('TOTAL PROCESSING TIME')
     print (datetime.now()-start)
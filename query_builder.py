@@ -0,0 +1,122 @@
+'''
+Column projection and sparse binary-code queries driven by the DataDictionary
+
+`select_list` names only the columns the pipeline uses (PID, DAY, ED, IP, PROCESS1, code and numeric columns)
+instead of `select *`. With --sparse_codes, the ordered claims scans are split in two: the wide query keeps
+everything but the Binary code columns, and a second query returns one (PID, DAY, column) row per non-zero
+binary flag (UNPIVOT on SQL Server, a generated UNION ALL elsewhere) in the same (PID, DAY) order.
+SparseRows merges the two back into rows in the dictionary's column order, so the encoder sees the same rows
+(and produces the same visits) as with the full projection
+'''
+from operator import itemgetter
+
+KEY_COLUMNS = ('PID', 'DAY', 'ED', 'IP', 'PROCESS1')
+UNION_GROUP_SIZE = 100
+
+
+def used_columns(datadict, binary=True):
+    '''
+    the columns the pipeline reads, in data dictionary order; without `binary`, Binary code columns are left out
+    '''
+    numeric_cols = set(datadict.numeric_cols)
+    columns = [col for col in datadict.columns
+               if col in KEY_COLUMNS or col in numeric_cols
+               or (col in datadict.code_cols and (binary or datadict.code_cols[col][1] != 'Binary'))]
+    return columns + [col for col in KEY_COLUMNS if col not in columns]
+
+
+def binary_columns(datadict):
+    return [col for col in datadict.columns if col in datadict.code_cols and datadict.code_cols[col][1] == 'Binary']
+
+
+def select_list(datadict, ARGS={}):
+    """the select list of a claims query: `*`, or the used columns with --project/--sparse_codes"""
+    if getattr(ARGS, 'project', False) or getattr(ARGS, 'sparse_codes', False):
+        return ", ".join('[{}]'.format(col) for col in used_columns(datadict))
+    return '*'
+
+
+def sparse_flags_query(engine, datadict, table, where_clause):
+    '''
+    (PID, DAY, flag) of every non-zero Binary code column of the rows of `table` matching `where_clause`, ordered by PID, DAY
+    flag is the column name (UNPIVOT, SQL Server) or its position in `binary_columns` (UNION ALL, other engines).
+    NULL flags are left out (the full-width path reports them as column errors)
+    '''
+    columns = binary_columns(datadict)
+    if engine.dialect.name == 'mssql':
+        return ('select PID, DAY, flag from (select PID, DAY, {} from {} where {}) as src '
+                'unpivot (flag_value for flag in ({})) as flags where flag_value != 0 order by PID, DAY'
+                .format(", ".join('cast([{0}] as int) as [{0}]'.format(col) for col in columns), table, where_clause,
+                        ", ".join('[{}]'.format(col) for col in columns)))
+    branches = ['select PID, DAY, {} as flag from {} where {} and [{}] != 0'.format(pos, table, where_clause, col)
+                for pos, col in enumerate(columns)]
+    # engines limit the terms of one compound select (500 in SQLite), so the branches are unioned in groups
+    groups = ['select * from ({})'.format(" union all ".join(branches[start:start + UNION_GROUP_SIZE]))
+              for start in range(0, len(branches), UNION_GROUP_SIZE)]
+    return 'select PID, DAY, flag from ({}) as flags order by PID, DAY'.format(" union all ".join(groups))
+
+
+class SparseRows():
+    '''
+    Result set merging the narrow claims rows (`dense`, ordered by PID, DAY, selected with `used_columns(datadict, binary=False)`)
+    with the ordered non-zero flags of `sparse_flags_query`. Rows come out as tuples in `used_columns(datadict)` order,
+    with 0 for every flag not returned. Both cursors must be ordered the same way
+    '''
+    def __init__(self, dense, flags, datadict):
+        self.dense = dense
+        self.flags = flags
+        self.columns = used_columns(datadict)
+        dense_columns = list(dense.keys())
+        binaries = binary_columns(datadict)
+        # narrow row + all-zero flags, reordered into the full column order by one itemgetter call
+        extended = {col: pos for pos, col in enumerate(dense_columns + binaries)}
+        self.reorder = itemgetter(*[extended[col] for col in self.columns])
+        self.zeros = [0] * len(binaries)
+        self.num_dense = len(dense_columns)
+        self.flag_pos = {}
+        for pos, col in enumerate(binaries):
+            self.flag_pos[col] = pos
+            self.flag_pos[pos] = pos
+        self.pid_idx = dense_columns.index('PID')
+        self.day_idx = dense_columns.index('DAY')
+        self.flag_batch = []
+        self.flag_batch_pos = 0
+
+    def keys(self):
+        return self.columns
+
+    def _current_flag(self, size):
+        if self.flag_batch_pos >= len(self.flag_batch):
+            self.flag_batch = self.flags.fetchmany(size or 10000) if self.flags is not None else []
+            self.flag_batch_pos = 0
+            if not self.flag_batch:
+                self.flags = None
+                return None
+        return self.flag_batch[self.flag_batch_pos]
+
+    def fetchmany(self, size=None):
+        batch = self.dense.fetchmany(size) if size else self.dense.fetchmany()
+        rows = []
+        for row in batch:
+            pid, day = row[self.pid_idx], row[self.day_idx]
+            key = (str(pid), day)
+            extended = list(row)
+            extended.extend(self.zeros)
+            flag = self._current_flag(size)
+            # flags of (PID, DAY)s the narrow query doesn't return (e.g. past --max) are skipped
+            while flag is not None and (str(flag[0]), flag[1]) != key and (flag[0], flag[1]) < (pid, day):
+                self.flag_batch_pos += 1
+                flag = self._current_flag(size)
+            while flag is not None and (str(flag[0]), flag[1]) == key:
+                extended[self.num_dense + self.flag_pos[flag[2]]] = 1
+                self.flag_batch_pos += 1
+                flag = self._current_flag(size)
+            rows.append(self.reorder(extended))
+        return rows
+
+    def __iter__(self):
+        batch = self.fetchmany(1000)
+        while batch:
+            for row in batch:
+                yield row
+            batch = self.fetchmany(1000)
@@ -0,0 +1,297 @@
+'''
+Stage-level timing and metrics for extraction runs
+
+A RunMetrics object collects, per named stage, cumulative wall time, call counts and row counts
+(stages nest, so times are inclusive: 'pid_counter.write' includes the writer time under it), plus the
+SQL queries issued (count and execute time, through engine events), windows/rows fetched with an estimate
+of the bytes fetched, peak RSS, and the slowest PIDs. `write` saves it all as a JSON report.
+Code reports to whatever `get_metrics()` returns: the active RunMetrics after `start_metrics()`, otherwise
+a no-op stand-in, so library callers (benchmarks, workers without a report) pay nothing
+'''
+from contextlib import contextmanager
+from datetime import datetime
+import heapq
+import json
+import os
+import pickle
+import sys
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """peak resident set size of this process in MB (None when it can't be read on this platform)"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 2**20, 1)
+    except (ImportError, AttributeError):
+        return None
+
+
+def current_rss_mb():
+    """resident set size of this process right now in MB (None when it can't be read on this platform)"""
+    try:
+        with open('/proc/self/statm') as fin:
+            return round(int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+    except (OSError, ValueError, AttributeError, IndexError):
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().rss / 2**20, 1)
+    except ImportError:
+        return None
+
+
+class MeteredCursor():
+    '''
+    Wraps a result set and charges every fetchmany/iteration to the 'sql.fetch' stage,
+    with an estimate of the bytes fetched (pickled size of the window's first row times its rows)
+    '''
+    def __init__(self, results, metrics):
+        self.results = results
+        self.metrics = metrics
+
+    def keys(self):
+        return self.results.keys()
+
+    def fetchmany(self, size=None):
+        start = perf_counter()
+        batch = self.results.fetchmany(size) if size else self.results.fetchmany()
+        self.metrics.add('sql.fetch', perf_counter() - start, rows=len(batch))
+        if batch:
+            self.metrics.bytes_fetched += len(pickle.dumps(tuple(batch[0]), protocol=pickle.HIGHEST_PROTOCOL)) * len(batch)
+        return batch
+
+    def __iter__(self):
+        batch = self.fetchmany(1000)
+        while batch:
+            for row in batch:
+                yield row
+            batch = self.fetchmany(1000)
+
+
+class TimedWriter():
+    """passes rows through to `writer`, charging the time to a stage"""
+    def __init__(self, writer, metrics, name):
+        self.writer = writer
+        self.metrics = metrics
+        self.name = name
+
+    def __len__(self):
+        return len(self.writer)
+
+    def __getattr__(self, attr):
+        return getattr(self.writer, attr)
+
+    def writerow(self, row):
+        start = perf_counter()
+        self.writer.writerow(row)
+        self.metrics.add(self.name, perf_counter() - start, rows=1)
+
+    def writerows(self, rows):
+        rows = list(rows)
+        start = perf_counter()
+        self.writer.writerows(rows)
+        self.metrics.add(self.name, perf_counter() - start, rows=len(rows))
+
+
+class RunMetrics():
+    '''
+    Collector for one run; see the module docstring. `slowest` is how many of the slowest PIDs to keep
+    '''
+    enabled = True
+
+    def __init__(self, slowest=20):
+        self.started = datetime.now()
+        self.start_time = perf_counter()
+        self.stages = {}
+        self.queries = 0
+        self.query_secs = 0.0
+        self.bytes_fetched = 0
+        self.slowest = slowest
+        self.slowest_pids = []
+        self.pid = None
+        self.pid_start = None
+        self.pid_rows = 0
+        self.info = {}
+        self.workers = []
+        self._patched = []
+        self._engines = []
+
+    def add(self, name, secs, calls=1, rows=0):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0.0, 0, 0]
+        stage[0] += secs
+        stage[1] += calls
+        stage[2] += rows
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start, rows=rows)
+
+    def instrument(self, owner, attr, name, rows=None):
+        '''
+        replace owner.attr (a function or method) with a timed wrapper charged to stage `name` until `close`
+        `rows(args)` optionally gives the number of rows handled by one call
+        '''
+        original = getattr(owner, attr)
+        metrics = self
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                metrics.add(name, perf_counter() - start, rows=rows(args) if rows else 0)
+        timed.__wrapped__ = original
+        setattr(owner, attr, timed)
+        self._patched.append((owner, attr, original))
+
+    def watch_engine(self, engine):
+        """count queries and their execute time through the engine's cursor events"""
+        from sqlalchemy import event
+
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info['metrics_query_start'] = perf_counter()
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            self.queries += 1
+            self.query_secs += perf_counter() - conn.info.pop('metrics_query_start', perf_counter())
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+        self._engines.append((engine, before, after))
+
+    def metered(self, results):
+        return MeteredCursor(results, self)
+
+    def timed_writer(self, writer, name):
+        return TimedWriter(writer, self, name)
+
+    def start_pid(self, pid):
+        """time spent between start_pid calls is charged to the previous PID (for the slowest PIDs list)"""
+        now = perf_counter()
+        if self.pid is not None:
+            entry = (now - self.pid_start, str(self.pid), self.pid_rows)
+            if len(self.slowest_pids) < self.slowest:
+                heapq.heappush(self.slowest_pids, entry)
+            else:
+                heapq.heappushpop(self.slowest_pids, entry)
+        self.pid = pid
+        self.pid_start = now
+        self.pid_rows = 0
+
+    def pid_row(self):
+        self.pid_rows += 1
+
+    def merge(self, report):
+        """fold in the report of a worker process"""
+        for name, stage in report['stages'].items():
+            self.add(name, stage['secs'], stage['calls'], stage['rows'])
+        self.queries += report['sql']['queries']
+        self.query_secs += report['sql']['execute_secs']
+        self.bytes_fetched += report['sql']['bytes_fetched_estimate']
+        for entry in report['slowest_pids']:
+            heapq.heappush(self.slowest_pids, (entry['secs'], entry['PID'], entry['rows']))
+        self.slowest_pids = heapq.nlargest(self.slowest, self.slowest_pids)
+        heapq.heapify(self.slowest_pids)
+        worker = {'peak_rss_mb': report['peak_rss_mb'], 'total_secs': report['total_secs']}
+        if report['info'].get('fetch_windows'):
+            worker['fetch_windows'] = report['info']['fetch_windows']
+        self.workers.append(worker)
+
+    def to_dict(self):
+        self.start_pid(None)
+        return {'started': self.started.strftime('%Y-%m-%dT%H:%M:%S'),
+                'total_secs': round(perf_counter() - self.start_time, 3),
+                'stages': {name: {'secs': round(secs, 4), 'calls': calls, 'rows': rows}
+                           for name, (secs, calls, rows) in sorted(self.stages.items(), key=lambda item: -item[1][0])},
+                'sql': {'queries': self.queries,
+                        'execute_secs': round(self.query_secs, 4),
+                        'bytes_fetched_estimate': self.bytes_fetched},
+                'peak_rss_mb': peak_rss_mb(),
+                'slowest_pids': [{'PID': pid, 'secs': round(secs, 4), 'rows': rows}
+                                 for secs, pid, rows in sorted(self.slowest_pids, reverse=True)],
+                'workers': self.workers,
+                'info': self.info}
+
+    def write(self, filepath):
+        report = self.to_dict()
+        with open(filepath, 'w') as fout:
+            json.dump(report, fout, indent=1, default=str)
+        return report
+
+    def close(self):
+        """undo instrument/watch_engine"""
+        for owner, attr, original in reversed(self._patched):
+            setattr(owner, attr, original)
+        self._patched = []
+        if self._engines:
+            from sqlalchemy import event
+            for engine, before, after in self._engines:
+                event.remove(engine, 'before_cursor_execute', before)
+                event.remove(engine, 'after_cursor_execute', after)
+            self._engines = []
+
+
+class NullMetrics():
+    """stand-in when no run is being measured: every hook is a no-op"""
+    enabled = False
+
+    def add(self, name, secs, calls=1, rows=0):
+        pass
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        yield
+
+    def metered(self, results):
+        return results
+
+    def timed_writer(self, writer, name):
+        return writer
+
+    def start_pid(self, pid):
+        pass
+
+    def pid_row(self):
+        pass
+
+    def merge(self, report):
+        pass
+
+
+_ACTIVE = NullMetrics()
+
+
+def get_metrics():
+    return _ACTIVE
+
+
+def start_metrics(slowest=20):
+    global _ACTIVE
+    _ACTIVE = RunMetrics(slowest)
+    return _ACTIVE
+
+
+def stop_metrics():
+    global _ACTIVE
+    metrics = _ACTIVE
+    if metrics.enabled:
+        metrics.close()
+    _ACTIVE = NullMetrics()
+    return metrics
@@ -0,0 +1,151 @@
+'''
+Local snapshot cache of the HICOR claims tables
+
+Each table is extracted once per PROCESS1 dataset into a local SQLite file (indexed on PID, DAY)
+under config['SNAPSHOT_DIR']. Snapshots are keyed by table name, the PROCESS1 filter and a hash of
+data_dictionary.csv + dictionary.pkl, so editing either file invalidates them. A JSON manifest
+next to each file records the key, column types, row count and creation time; snapshots older than
+config['SNAPSHOT_MAX_AGE_DAYS'] (when set) are rebuilt unless running --offline.
+The returned engine understands the SQL Server flavoured queries in process_hicor.py (see sql_engine.initialize_sqlite).
+'''
+from datetime import datetime, timedelta
+from decimal import Decimal
+import hashlib
+import json
+import os
+import sqlite3
+from sql_engine import initialize_sqlite
+
+SQLITE_TYPES = {'Char': 'TEXT', 'Num': 'REAL', 'Binary': 'INTEGER'}
+
+
+def dictionary_hash(filepaths=('./data_dictionary.csv', './dictionary.pkl')):
+    digest = hashlib.sha1()
+    for filepath in filepaths:
+        with open(filepath, 'rb') as fin:
+            digest.update(fin.read())
+    return digest.hexdigest()
+
+
+def snapshot_path(config, table, dataset):
+    key = hashlib.sha1("|".join([table, "PROCESS1={}".format(dataset), dictionary_hash()]).encode('utf-8')).hexdigest()
+    return os.path.join(config.get('SNAPSHOT_DIR', './snapshots'), "{}_{}_{}.sqlite".format(table, dataset, key[:12]))
+
+
+def read_manifest(path):
+    manifest_file = path + '.json'
+    if not os.path.exists(path) or not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as fin:
+        return json.load(fin)
+
+
+def is_stale(manifest, config):
+    max_age = config.get('SNAPSHOT_MAX_AGE_DAYS')
+    if not max_age:
+        return False
+    created = datetime.strptime(manifest['created'], '%Y-%m-%dT%H:%M:%S')
+    return datetime.now() - created > timedelta(days=max_age)
+
+
+def _column_types(columns, batch, datadict_types):
+    '''
+    SQLite column affinities for the snapshot table: taken from the first non-null value fetched,
+    falling back to the data dictionary DataType (so comparisons such as ANYCLAIM != '0' behave as on SQL Server)
+    '''
+    types = []
+    for pos, col in enumerate(columns):
+        value = next((row[pos] for row in batch if row[pos] is not None), None)
+        if isinstance(value, (bool, int)):
+            types.append('INTEGER')
+        elif isinstance(value, (float, Decimal)):
+            types.append('REAL')
+        elif isinstance(value, str):
+            types.append('TEXT')
+        else:
+            types.append(SQLITE_TYPES.get(datadict_types.get(col), ''))
+    return types
+
+
+def _adapt(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def build_snapshot(engine, config, table, dataset, path, datadict_types=None):
+    '''
+    stream `table` (PROCESS1 = dataset) from the live engine into a new SQLite file at `path`
+    the file is written under a temporary name and only moved into place (with its manifest) once complete
+    '''
+    print("Building local snapshot of {} (PROCESS1={}) at {}...".format(table, dataset, path))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    results = engine.execute('select * from {} where PROCESS1={}'.format(table, dataset))
+    columns = list(results.keys())
+    batch = results.fetchmany(config['WINDOW_SIZE'])
+    types = _column_types(columns, batch, datadict_types or {})
+    rows = 0
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('create table {} ({})'.format(table, ", ".join(
+            '"{}" {}'.format(col, col_type).strip() for col, col_type in zip(columns, types))))
+        insert = 'insert into {} values ({})'.format(table, ", ".join('?' * len(columns)))
+        while batch:
+            conn.executemany(insert, [tuple(_adapt(value) for value in row) for row in batch])
+            rows += len(batch)
+            batch = results.fetchmany(config['WINDOW_SIZE'])
+        if 'PID' in columns:
+            conn.execute('create index {0}_pid_day on {0} (PID{1})'.format(table, ', DAY' if 'DAY' in columns else ''))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    manifest = {'table': table,
+                'dataset': dataset,
+                'dictionary_hash': dictionary_hash(),
+                'columns': columns,
+                'types': types,
+                'rows': rows,
+                'created': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(path + '.json', 'w') as fout:
+        json.dump(manifest, fout, indent=1)
+    print("Snapshot of {} complete: {} rows".format(table, rows))
+    return manifest
+
+
+def ensure_snapshots(engine, config, dataset, datadict_types=None, offline=False, refresh=False):
+    '''
+    make sure local snapshots of TABLE_NAME and PARTIAL_EVENT_TABLE_NAME exist for `dataset`
+    (building or rebuilding them from `engine` as needed) and return {table: snapshot path}
+    with `offline`, the live engine is never used and a missing snapshot is an error
+    '''
+    paths = {}
+    for table in (config['TABLE_NAME'], config['PARTIAL_EVENT_TABLE_NAME']):
+        path = snapshot_path(config, table, dataset)
+        manifest = read_manifest(path)
+        if offline:
+            if manifest is None:
+                raise ValueError("No local snapshot of {} for PROCESS1={} at {} (run once without --offline to build it)"
+                                 .format(table, dataset, path))
+            if is_stale(manifest, config):
+                print("Warning: snapshot of {} is older than SNAPSHOT_MAX_AGE_DAYS (created {})".format(table, manifest['created']))
+        elif refresh or manifest is None or is_stale(manifest, config):
+            build_snapshot(engine, config, table, dataset, path, datadict_types)
+        else:
+            print("Using local snapshot of {} ({} rows, created {})".format(table, manifest['rows'], manifest['created']))
+        paths[table] = path
+    return paths
+
+
+def connect_snapshots(paths, seed=None):
+    '''
+    engine over the snapshot files: the first table's file is the main database, the others are attached
+    '''
+    files = list(paths.values())
+    attach = {"snapshot_{}".format(pos): path for pos, path in enumerate(files[1:], start=1)}
+    return initialize_sqlite(files[0], attach=attach, seed=seed)
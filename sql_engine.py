@@ -1,4 +1,7 @@
-from sqlalchemy import create_engine
+import random
+import re
+import zlib
+from sqlalchemy import create_engine, event
 import urllib
 
 def initialize(config, trusted=False):
@@ -14,4 +17,98 @@ def initialize(config, trusted=False):
 	return create_engine('mssql+pymssql://{}:{}@{}/{}'.format(urllib.parse.quote_plus(sql_config['user']),
 															  urllib.parse.quote_plus(sql_config['pwd']),
 															  sql_config['host'], sql_config['db']),
-						 echo=(sql_config['echo'].lower == 'true'))
\ No newline at end of file
+						 echo=(sql_config['echo'].lower == 'true'))
+
+
+TOP_PATTERN = re.compile(r'^(\s*select\s+)top\s+(\d+)\s+', re.IGNORECASE)
+
+def rewrite_mssql(statement):
+	"""
+	translate the few SQL Server-only constructs our queries use into SQLite:
+	`select top N ...` becomes `select ... limit N`, and newid() becomes random()
+	"""
+	match = TOP_PATTERN.match(statement)
+	if match:
+		statement = "{}{} limit {}".format(match.group(1), statement[match.end():].rstrip().rstrip(';'), match.group(2))
+	return statement.replace('newid()', 'random()')
+
+def _checksum(value):
+	# stable across processes (unlike hash()), so --workers buckets agree between runs
+	return zlib.crc32(str(value).encode('utf-8')) & 0x7fffffff
+
+def initialize_sqlite(path, attach=None, seed=None):
+	"""
+	SQLite engine that accepts the SQL Server flavoured queries in process_hicor.py
+	`attach` is an optional {schema_name: database_path} dict of extra files to ATTACH, so their tables
+	can be queried unqualified. `seed` makes `order by newid()` reproducible
+	"""
+	print("Connecting to local SQLite database {}...".format(path))
+	engine = create_engine('sqlite:///{}'.format(path), connect_args={'check_same_thread': False})
+	rng = random.Random(seed)
+
+	@event.listens_for(engine, 'connect')
+	def _on_connect(dbapi_connection, connection_record):
+		dbapi_connection.create_function('checksum', 1, _checksum)
+		dbapi_connection.create_function('random', 0, lambda: rng.getrandbits(63))
+		for schema, attach_path in (attach or {}).items():
+			dbapi_connection.execute("attach database '{}' as {}".format(attach_path.replace("'", "''"), schema))
+
+	@event.listens_for(engine, 'before_cursor_execute', retval=True)
+	def _on_execute(conn, cursor, statement, parameters, context, executemany):
+		return rewrite_mssql(statement), parameters
+
+	return engine
+
+
+class RawResult():
+	"""
+	plain-tuple result set over a raw DBAPI cursor, with the `keys()`/`fetchmany(size)` interface of a SQLAlchemy result
+	but no RowProxy per row. The connection goes back to the pool once the rows run out (or on `close`)
+	"""
+	def __init__(self, connection, cursor):
+		self.connection = connection
+		self.cursor = cursor
+		self.columns = [col[0] for col in cursor.description]
+
+	def keys(self):
+		return self.columns
+
+	def fetchmany(self, size=None):
+		if self.cursor is None:
+			return []
+		batch = self.cursor.fetchmany(size or self.cursor.arraysize)
+		if not batch:
+			self.close()
+		return batch
+
+	def __iter__(self):
+		batch = self.fetchmany()
+		while batch:
+			for row in batch:
+				yield row
+			batch = self.fetchmany()
+
+	def close(self):
+		if self.cursor is not None:
+			self.cursor.close()
+			self.connection.close()
+			self.cursor = None
+
+def stream_tuples(engine, statement, arraysize=10000):
+	"""
+	execute `statement` on a raw DBAPI cursor of `engine` and return a RawResult fetching `arraysize` rows per round trip
+	pymssql and pyodbc (default forward-only cursor) stream rows from the server as they are fetched, so client
+	memory stays flat on full table scans. SQLAlchemy cursor events don't run, so local SQLite engines get the
+	SQL Server rewrite here
+	"""
+	connection = engine.raw_connection()
+	try:
+		cursor = connection.cursor()
+		cursor.arraysize = arraysize
+		if engine.dialect.name == 'sqlite':
+			statement = rewrite_mssql(statement)
+		cursor.execute(statement)
+	except Exception:
+		connection.close()
+		raise
+	return RawResult(connection, cursor)
@@ -0,0 +1,176 @@
+'''
+Synthetic HICOR claims data for reproducible local runs and benchmarks
+
+Generates a claims-day table and a partial-event table that follow data_dictionary.csv
+(Static columns are fixed per patient, Time-Varying ones drawn per claim-day) and loads them
+into a local SQLite database that process_hicor.py can query through sql_engine.initialize_sqlite
+'''
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+from process_hicor import DataDictionary
+from sql_engine import initialize_sqlite
+
+# rough shape of the real extract: long-tailed history lengths, mostly active claim-days,
+# a few percent of days with an ED visit and fewer with an inpatient stay
+DEFAULT_PARAMS = {'mean_days': 60,
+                  'max_days': 730,
+                  'anyclaim_rate': 0.75,
+                  'ed_rate': 0.03,
+                  'ip_rate': 0.015,
+                  'static_flag_rate': 0.1,
+                  'daily_flag_rate': 0.02,
+                  'null_char_rate': 0.1,
+                  'dataset_split': (0.6, 0.2, 0.2)}
+
+
+def read_column_order(filepath='./data_dictionary.csv'):
+    with open(filepath, "r") as fin:
+        return [row['Name'] for row in csv.DictReader(fin)]
+
+
+def read_temporal(filepath='./data_dictionary.csv'):
+    with open(filepath, "r") as fin:
+        return {row['Name']: (row['DataType'], row['Temporal'].strip()) for row in csv.DictReader(fin)}
+
+
+def code_values(datadict):
+    '''
+    known values of every Char code column, recovered from the "{col}_{val}" code mapping keys
+    '''
+    values = {}
+    for col, codekey in datadict.code_cols.items():
+        if codekey[1] != 'Binary':
+            prefix = col + '_'
+            values[col] = [key[len(prefix):] for key in datadict.code_mappings if key.startswith(prefix)]
+    return values
+
+
+def generate_patient(rng, pid, columns, datadict, col_types, char_values, params=DEFAULT_PARAMS):
+    '''
+    return (claims rows, partial event rows) for one synthetic patient, as tuples in `columns` order
+    '''
+    process1 = rng.choices([1, 2, 3], weights=params['dataset_split'])[0]
+    num_days = min(params['max_days'], 1 + int(rng.expovariate(1.0 / params['mean_days'])))
+    days = sorted(rng.sample(range(1, int(num_days * 1.5) + 2), num_days))
+
+    def _value(col, static):
+        data_type = col_types.get(col, ('Num', 'Static'))[0]
+        if col in datadict.code_cols:
+            if datadict.code_cols[col][1] == 'Binary':
+                rate = params['static_flag_rate'] if static else params['daily_flag_rate']
+                return 1 if rng.random() < rate else 0
+            options = char_values.get(col)
+            if not options or rng.random() < params['null_char_rate']:
+                return None
+            return rng.choice(options)
+        if col in datadict.numeric_cols:
+            if col in ('MEDIANINCOME',) and rng.random() < 0.05:
+                return None
+            return rng.randint(0, 20) if not static else rng.randint(0, 9999)
+        if data_type in ('Char', 'Datetime'):
+            return None
+        return 0
+
+    static_values = {col: _value(col, True) for col in columns if col_types.get(col, ('', 'Static'))[1] == 'Static'}
+    rows = []
+    partials = []
+    for day in days:
+        anyclaim = 1 if rng.random() < params['anyclaim_rate'] else 0
+        ed = 1 if anyclaim and rng.random() < params['ed_rate'] else 0
+        ip = 1 if anyclaim and rng.random() < params['ip_rate'] else 0
+        fixed = {'PID': pid, 'DAY': day, 'ED': ed, 'IP': ip, 'ANYCLAIM': anyclaim, 'PROCESS1': process1}
+        values = []
+        for col in columns:
+            if col in fixed:
+                values.append(fixed[col])
+            elif col in static_values:
+                values.append(static_values[col])
+            else:
+                values.append(_value(col, False) if anyclaim else (0 if col in datadict.code_cols and
+                                                                    datadict.code_cols[col][1] == 'Binary' else None))
+        rows.append(tuple(values))
+        if ed or ip:
+            # the partial event day: claims seen before the event on that day, i.e. a thinned copy of the day
+            partials.append(tuple(0 if (col in datadict.code_cols and datadict.code_cols[col][1] == 'Binary'
+                                        and col not in static_values and rng.random() < 0.5) else val
+                                  for col, val in zip(columns, values)))
+    return rows, partials
+
+
+def _sqlite_type(col, col_types):
+    if col == 'PID':
+        return 'TEXT'
+    return {'Char': 'TEXT', 'Num': 'REAL', 'Binary': 'INTEGER'}.get(col_types.get(col, ('Num',))[0], '')
+
+
+def build_database(path, config, num_patients, seed=0, datadict=None, params=DEFAULT_PARAMS):
+    '''
+    write a synthetic claims table (config['TABLE_NAME']) and partial event table
+    (config['PARTIAL_EVENT_TABLE_NAME']) with `num_patients` patients into a new SQLite file at `path`
+    returns a dict of row counts
+    '''
+    datadict = datadict or DataDictionary()
+    columns = read_column_order()
+    col_types = read_temporal()
+    # DAY/ED/IP/ANYCLAIM/PROCESS1 are integers whatever the dictionary says
+    for col in ('DAY', 'ED', 'IP', 'ANYCLAIM', 'PROCESS1'):
+        col_types[col] = ('Binary', col_types.get(col, ('', 'Time-Varying'))[1])
+    char_values = code_values(datadict)
+    rng = random.Random(seed)
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    counts = {'patients': num_patients, 'claims': 0, 'partial_events': 0}
+    try:
+        col_defs = ", ".join('"{}" {}'.format(col, _sqlite_type(col, col_types)).strip() for col in columns)
+        insert = "insert into {} values ({})".format('{}', ", ".join('?' * len(columns)))
+        for table in (config['TABLE_NAME'], config['PARTIAL_EVENT_TABLE_NAME']):
+            conn.execute('create table {} ({})'.format(table, col_defs))
+        for patient_num in range(num_patients):
+            rows, partials = generate_patient(rng, "{}".format(170300000000 + patient_num), columns,
+                                              datadict, col_types, char_values, params)
+            conn.executemany(insert.format(config['TABLE_NAME']), rows)
+            conn.executemany(insert.format(config['PARTIAL_EVENT_TABLE_NAME']), partials)
+            counts['claims'] += len(rows)
+            counts['partial_events'] += len(partials)
+        for table in (config['TABLE_NAME'], config['PARTIAL_EVENT_TABLE_NAME']):
+            conn.execute('create index {0}_pid_day on {0} (PID, DAY)'.format(table))
+        conn.commit()
+    finally:
+        conn.close()
+    return counts
+
+
+def make_synthetic_engine(path, config, num_patients, seed=0, datadict=None):
+    """build a synthetic database and return an engine for it"""
+    counts = build_database(path, config, num_patients, seed, datadict)
+    print("Synthetic HICOR data: {patients} patients, {claims} claim-days, {partial_events} partial event days".format(**counts))
+    return initialize_sqlite(path, seed=seed)
+
+
+def parse_arguments(parser):
+    """size, seed and location of the synthetic database"""
+    parser.add_argument('--patients', type=int, default=1000,
+                        help="number of synthetic patients")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed for data generation")
+    parser.add_argument('--db', type=str, default='./synthetic_hicor.db',
+                        help="path of the SQLite database to create")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ARGS = parse_arguments(PARSER)
+    path = './config.json' if os.path.exists('./config.json') else './config_default.json'
+    with open(path) as fin:
+        config = json.load(fin)
+    counts = build_database(ARGS.db, config, ARGS.patients, ARGS.seed)
+    print("Synthetic HICOR data written to {}: {patients} patients, {claims} claim-days, {partial_events} partial event days"
+          .format(ARGS.db, **counts))
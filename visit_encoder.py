@@ -0,0 +1,267 @@
+""" Compiled column-plan encoder for turning HICOR result-set rows into RETAIN visits """
+from operator import itemgetter
+import numpy as np
+import pandas as pd
+
+_MISSING = object()
+
+
+def compile_code_tables(datadict):
+    '''
+    precompute the value->code-id lookups for every code column of a DataDictionary
+    returns a tuple of:
+      binary codes ({col: code_id} for Binary columns)
+      char tables ({col: {formatted_value: code_id}} for all other code columns)
+    only truthy code ids are kept, matching the `if mapped_code` check in build_visit_dict
+    '''
+    binary_codes = {}
+    char_tables = {}
+    for col, codekey in datadict.code_cols.items():
+        if codekey[1] == 'Binary':
+            binary_codes[col] = datadict.code_mappings.get(col)
+        else:
+            char_tables[col] = {}
+    # mapping keys are "{col}_{val}"; column names can contain underscores themselves,
+    # so every underscore is tried as the split point
+    for key, code_id in datadict.code_mappings.items():
+        if not code_id or not isinstance(key, str):
+            continue
+        pos = key.find('_')
+        while pos != -1:
+            table = char_tables.get(key[:pos])
+            if table is not None:
+                table[key[pos + 1:]] = code_id
+            pos = key.find('_', pos + 1)
+    return binary_codes, char_tables
+
+
+class VisitEncoder():
+    '''
+    Column plan compiled once from a DataDictionary and the column order of a result set.
+    `encode` turns a raw row (tuple, RowProxy or anything indexable by position) into the
+    same visit dict that build_visit_dict produces for dict(zip(columns, row))
+    Static code columns (demographics, diagnoses, ...) repeat on every claim-day of a patient, so their codes are
+    looked up once per run of consecutive rows with the same static values (i.e. once per PID in the PID, DAY
+    ordered pulls) and only the Time-Varying code columns are looked up for every row
+    '''
+    def __init__(self, datadict, columns, config, code_tables=None):
+        self.columns = list(columns)
+        positions = {col: idx for idx, col in enumerate(self.columns)}
+        self.pid_idx = positions['PID']
+        self.day_idx = positions.get('DAY')
+        self.ed_idx = positions.get('ED')
+        self.ip_idx = positions.get('IP')
+        self.num_numerics = len(datadict.numeric_cols)
+
+        binary_codes, char_tables = code_tables or compile_code_tables(datadict)
+        default_values = config.get('DEFAULT_VALUES') or {}
+        numeric_slots = {}
+        for slot, col in enumerate(datadict.numeric_cols):
+            numeric_slots.setdefault(col, slot)
+
+        # code columns are kept in result-set order so the code set is filled in the same
+        # order as build_visit_dict (and `list(codeset)` comes out identical)
+        self.code_plan = []
+        self.numeric_plan = []
+        for col, idx in positions.items():
+            codekey = datadict.code_cols.get(col)
+            if codekey:
+                if codekey[1] == 'Binary':
+                    self.code_plan.append((idx, col, binary_codes.get(col), None))
+                else:
+                    self.code_plan.append((idx, col, None, char_tables.get(col, {})))
+            elif col in numeric_slots:
+                self.numeric_plan.append((idx, numeric_slots[col], col, default_values.get(col, _MISSING)))
+        self.static_plan = []
+        self.varying_plan = []
+        for plan_pos, (idx, col, binary_code, char_table) in enumerate(self.code_plan):
+            plan = self.static_plan if datadict.code_cols[col][2].strip() == 'Static' else self.varying_plan
+            plan.append((plan_pos, idx, binary_code, char_table))
+        self.static_values = itemgetter(*[idx for _, idx, _, _ in self.static_plan]) if self.static_plan else None
+        # static values of the last row encoded and their (plan position, code id) pairs
+        self._static_key = _MISSING
+        self._static_codes = []
+        self._batch_plan = None
+
+    def encode(self, row, error_cols):
+        """ encode a single raw row into a visit dict, adding unparseable code columns to `error_cols` """
+        numerics = [None] * self.num_numerics
+        for idx, slot, col, default in self.numeric_plan:
+            val = row[idx]
+            if val is None:
+                if default is _MISSING:
+                    print("Numeric columns must be non null or contained within the DEFAULT_VALUES \
+                            dictionary in config.json - Column  ({}) defaulting to 0 ".format(col))
+                    val = 0
+                else:
+                    val = default
+            numerics[slot] = val
+        try:
+            codeset = self._encode_codes(row)
+        except Exception:
+            codeset = self._encode_codes_safely(row, error_cols)
+        return {'PID': row[self.pid_idx],
+                'numerics': numerics,
+                'DAY': int(row[self.day_idx]) if self.day_idx is not None else 0,
+                'ED': int(row[self.ed_idx]) if self.ed_idx is not None else 0,
+                'IP': int(row[self.ip_idx]) if self.ip_idx is not None else 0,
+                'codes': list(codeset)}
+
+    def _encode_codes(self, row):
+        static_key = self.static_values(row) if self.static_values else None
+        if static_key != self._static_key:
+            self._static_codes = self._lookup_codes(row, self.static_plan)
+            self._static_key = static_key
+        codes = self._lookup_codes(row, self.varying_plan)
+        if self._static_codes:
+            # interleave back into column order, so the set is filled in the same order as build_visit_dict
+            codes = sorted(self._static_codes + codes)
+        return set(code_id for _, code_id in codes)
+
+    @staticmethod
+    def _lookup_codes(row, plan):
+        """ (plan position, code id) of every code column in `plan` that maps to a code """
+        codes = []
+        for plan_pos, idx, binary_code, char_table in plan:
+            val = row[idx]
+            if char_table is None:
+                # `val == 0` skips the common case without the int() call;
+                # None and empty strings still go through int() so they raise like before
+                if val == 0:
+                    continue
+                if int(val) and binary_code:
+                    codes.append((plan_pos, binary_code))
+            else:
+                mapped_code = char_table.get(val if val.__class__ is str else format(val))
+                if mapped_code:
+                    codes.append((plan_pos, mapped_code))
+        return codes
+
+    def _encode_codes_safely(self, row, error_cols):
+        # slow path, only used for rows where at least one code column failed to parse
+        codeset = set()
+        for idx, col, binary_code, char_table in self.code_plan:
+            val = row[idx]
+            try:
+                if char_table is None:
+                    if int(val) and binary_code:
+                        codeset.add(binary_code)
+                else:
+                    mapped_code = char_table.get(format(val))
+                    if mapped_code:
+                        codeset.add(mapped_code)
+            except Exception:
+                error_cols.add(col)
+        return codeset
+
+    def encode_batch(self, rows, error_cols):
+        '''
+        encode a whole fetchmany window at once:
+          binary code columns are mapped to code ids with a single array operation
+          char code columns are mapped through a categorical lookup against the code tables
+          static code columns are only mapped on the first row of each run of rows with the same static values
+          numerics have their NULLs filled per column
+        visits are identical to calling `encode` on each row (the NULL numeric warning is printed once per column per window).
+        windows with unparseable binary values fall back to the row-by-row path so error columns are reported the same way
+        '''
+        if not rows:
+            return []
+        if self._batch_plan is None:
+            self._batch_plan = (self._compile_batch_plan(self.static_plan), self._compile_batch_plan(self.varying_plan))
+        static_plan, varying_plan = self._batch_plan
+        frame = np.array(rows if isinstance(rows[0], tuple) else [tuple(row) for row in rows], dtype=object)
+        if frame.ndim != 2 or frame.shape[1] != len(self.columns):
+            return [self.encode(row, error_cols) for row in rows]
+        num_rows = frame.shape[0]
+
+        code_ids = np.zeros((num_rows, len(self.code_plan)), dtype=np.int32)
+        if self.static_plan:
+            static_values = frame[:, [idx for _, idx, _, _ in self.static_plan]]
+            run_starts = np.ones(num_rows, dtype=bool)
+            run_starts[1:] = (static_values[1:] != static_values[:-1]).any(axis=1)
+            run_ids = np.zeros((int(run_starts.sum()), len(self.code_plan)), dtype=np.int32)
+            if not self._map_code_ids(frame[run_starts], static_plan, run_ids):
+                return [self.encode(row, error_cols) for row in rows]
+            code_ids = run_ids[np.cumsum(run_starts) - 1]
+        if not self._map_code_ids(frame, varying_plan, code_ids):
+            return [self.encode(row, error_cols) for row in rows]
+
+        numerics = np.full((num_rows, self.num_numerics), None, dtype=object)
+        for idx, slot, col, default in self.numeric_plan:
+            values = frame[:, idx]
+            missing = np.equal(values, None)
+            if missing.any():
+                values = values.copy()
+                if default is _MISSING:
+                    print("Numeric columns must be non null or contained within the DEFAULT_VALUES \
+                            dictionary in config.json - Column  ({}) defaulting to 0 ({} rows)".format(col, int(missing.sum())))
+                    default = 0
+                values[missing] = default
+            numerics[:, slot] = values
+
+        # np.nonzero walks row-major, so each row's ids come out in column order,
+        # which keeps `list(set(...))` identical to the row-by-row encoder
+        row_nums, plan_nums = np.nonzero(code_ids)
+        flat_ids = code_ids[row_nums, plan_nums].tolist()
+        bounds = np.searchsorted(row_nums, np.arange(num_rows + 1)).tolist()
+
+        pids = frame[:, self.pid_idx].tolist()
+        days = self._int_column(frame, self.day_idx, num_rows)
+        eds = self._int_column(frame, self.ed_idx, num_rows)
+        ips = self._int_column(frame, self.ip_idx, num_rows)
+        return [{'PID': pids[i],
+                 'numerics': numeric_row,
+                 'DAY': days[i],
+                 'ED': eds[i],
+                 'IP': ips[i],
+                 'codes': list(set(flat_ids[bounds[i]:bounds[i + 1]]))}
+                for i, numeric_row in enumerate(numerics.tolist())]
+
+    @staticmethod
+    def _map_code_ids(frame, batch_plan, code_ids):
+        '''
+        fill the `batch_plan` columns of `code_ids` with the code id of each row of `frame` (0 for no code)
+        returns False when a binary column has unparseable values
+        '''
+        binary_pos, binary_idx, binary_ids, char_plan = batch_plan
+        if len(binary_idx):
+            try:
+                flags = frame[:, binary_idx].astype(np.int64)
+            except (TypeError, ValueError, OverflowError):
+                return False
+            code_ids[:, binary_pos] = np.where(flags != 0, binary_ids, 0)
+        for plan_pos, idx, category_index, category_ids in char_plan:
+            values = frame[:, idx]
+            nulls = np.equal(values, None)
+            if nulls.any():
+                # build_visit_dict looks NULLs up as "{col}_None"
+                values = values.copy()
+                values[nulls] = 'None'
+            if pd.api.types.infer_dtype(values, skipna=False) != 'string':
+                values = np.array([format(val) for val in values], dtype=object)
+            codes = category_index.get_indexer(values)
+            code_ids[:, plan_pos] = np.where(codes >= 0, category_ids[codes], 0)
+        return True
+
+    @staticmethod
+    def _compile_batch_plan(plan):
+        binary_pos, binary_idx, binary_ids, char_plan = [], [], [], []
+        for plan_pos, idx, binary_code, char_table in plan:
+            if char_table is None:
+                binary_pos.append(plan_pos)
+                binary_idx.append(idx)
+                binary_ids.append(binary_code or 0)
+            else:
+                # the categorical lookup: a hashed index over the known values of the column,
+                # -1 (not found) lands on the trailing 0 in `category_ids`
+                category_index = pd.Index(list(char_table.keys()), dtype=object)
+                category_ids = np.array(list(char_table.values()) + [0], dtype=np.int32)
+                char_plan.append((plan_pos, idx, category_index, category_ids))
+        return (np.array(binary_pos, dtype=np.intp), np.array(binary_idx, dtype=np.intp),
+                np.array(binary_ids, dtype=np.int32), char_plan)
+
+    @staticmethod
+    def _int_column(frame, idx, num_rows):
+        if idx is None:
+            return [0] * num_rows
+        return [int(val) for val in frame[:, idx]]
@@ -0,0 +1,67 @@
+'''
+Per-PID watermarks for incremental (--delta) extraction
+
+A watermark is one grouped query's summary of every PID's active claim-days: max DAY, row count, sum of DAY
+and the number of ED and IP days (plus max(config['LOAD_TIMESTAMP_COLUMN']) when the table has a load
+timestamp), and the same for the partial event table with --use_partials. It is saved next to the output;
+on the next --delta run the PIDs whose summary changed (new/removed days, new events, reloaded rows) are the
+only ones re-extracted, and their rows replace the old ones in the output
+'''
+import os
+import pickle
+
+DELTA_PID_CHUNK = 1000
+
+
+def _summary_query(config, table, where_clause):
+    aggregates = ['max(DAY)', 'count(*)', 'sum(DAY)', 'sum(case when ED = 1 then 1 else 0 end)',
+                  'sum(case when IP = 1 then 1 else 0 end)']
+    if config.get('LOAD_TIMESTAMP_COLUMN'):
+        aggregates.append('max({})'.format(config['LOAD_TIMESTAMP_COLUMN']))
+    return 'select PID, {} from {} where {} group by PID'.format(", ".join(aggregates), table, where_clause)
+
+
+def read_watermarks(engine, config, dataset_clause, use_partials=False):
+    '''
+    {str(PID): (claims summary, partial event summary or None)} for the PIDs of the claims scan (and of the partial event table)
+    '''
+    summaries = {}
+    results = engine.execute(_summary_query(config, config['TABLE_NAME'], 'ANYCLAIM != 0 and PID is not null and {}'.format(dataset_clause)))
+    for row in results:
+        summaries[str(row[0])] = (tuple(row[1:]), None)
+    if use_partials:
+        results = engine.execute(_summary_query(config, config['PARTIAL_EVENT_TABLE_NAME'], 'PID is not null and {}'.format(dataset_clause)))
+        for row in results:
+            claims = summaries.get(str(row[0]), (None, None))[0]
+            summaries[str(row[0])] = (claims, tuple(row[1:]))
+    return summaries
+
+
+def changed_pids(previous, current):
+    '''
+    (PIDs that are new or whose summary changed, PIDs that are gone) between two watermarks
+    '''
+    changed = set(pid for pid, summary in current.items() if previous.get(pid) != summary)
+    removed = set(previous).difference(current)
+    return changed, removed
+
+
+def source_pid(output_pid, pids):
+    """the claims PID of an output row: the PID itself, or the PID before a split-on-event '_<n>' suffix"""
+    return output_pid if output_pid in pids else output_pid.rsplit('_', 1)[0]
+
+
+def save_watermarks(watermark_file, run_key, watermarks):
+    tmp_file = watermark_file + '.tmp'
+    with open(tmp_file, 'wb') as fout:
+        pickle.dump({'run_key': run_key, 'pids': watermarks}, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, watermark_file)
+
+
+def load_watermarks(watermark_file, run_key):
+    """the saved watermarks, or None if there are none for a run with this key"""
+    if not os.path.exists(watermark_file):
+        return None
+    with open(watermark_file, 'rb') as fin:
+        saved = pickle.load(fin)
+    return saved['pids'] if saved.get('run_key') == run_key else None